@@ -0,0 +1,281 @@
+"""Нагрузочный стенд: синтетические апдейты через dp.feed_update без обращений к Telegram.
+
+Запуск: python bench.py [--users 200] [--concurrency 50] [--rounds 1] [--api-latency-ms 0]
+                        [--database-url sqlite+aiosqlite:///bench.db] [--output bench_output.txt]
+                        [--check-plans]
+
+Каждый пользователь проходит сценарий start → play → agree_lottery → buy_10 → balance → referral,
+после чего тираж рассчитывается и победители получают уведомления. Бот работает с фальшивой
+сессией, которая записывает вызовы API. Отчёт: апдейты/с, p50/p99 задержки и запросы к БД на апдейт
+по каждому шагу и планы запросов к draws/draw_entries (FULL SCAN — индекс не используется;
+с --check-plans стенд тогда завершается с кодом 1 — для проверки в CI).
+"""
+import argparse
+import asyncio
+import contextvars
+import itertools
+import os
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+from datetime import datetime
+
+# bot.py читает настройки при импорте
+os.environ.setdefault("API_TOKEN", "42:BENCH")
+os.environ.setdefault("ADMIN_ID", "0")
+os.environ.setdefault("CRYPTOPAY_TOKEN", "bench")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+SCENARIO = ("start", "play", "agree_lottery", "buy_10", "balance", "referral")
+START_BALANCE = 100.0
+
+def percentile(values, q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * q))]
+
+def make_fake_session_class():
+    from aiogram.client.session.base import BaseSession
+
+    class FakeSession(BaseSession):
+        """Сессия бота без сети: записывает вызовы и отвечает правдоподобными объектами"""
+
+        def __init__(self, latency: float = 0.0):
+            super().__init__()
+            self.latency = latency
+            self.calls = Counter()
+            self._message_ids = itertools.count(1000)
+
+        async def make_request(self, bot, method, timeout=None):
+            name = type(method).__name__
+            self.calls[name] += 1
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            return method.build_response({"ok": True, "result": self._result(method)}).result
+
+        def _result(self, method):
+            returning = str(getattr(method, "__returning__", ""))
+            if "Message" in returning:
+                chat_id = getattr(method, "chat_id", None) or 0
+                return {
+                    "message_id": next(self._message_ids),
+                    "date": int(time.time()),
+                    "chat": {"id": chat_id, "type": "private"},
+                    "text": getattr(method, "text", None),
+                }
+            if returning.endswith("User'>"):
+                return {"id": 42, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+            return True
+
+        async def close(self):
+            pass
+
+        async def stream_content(self, url, timeout, chunk_size, raise_for_status):
+            yield b""
+
+    return FakeSession
+
+class UpdateFactory:
+    def __init__(self):
+        self._ids = itertools.count(1)
+
+    def _user(self, user_id: int) -> dict:
+        return {"id": user_id, "is_bot": False, "first_name": f"user{user_id}", "language_code": "ru"}
+
+    def command(self, user_id: int, text: str) -> dict:
+        return {"update_id": next(self._ids), "message": {
+            "message_id": next(self._ids),
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": self._user(user_id),
+            "text": text,
+            "entities": [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}],
+        }}
+
+    def callback(self, user_id: int, data: str) -> dict:
+        return {"update_id": next(self._ids), "callback_query": {
+            "id": str(next(self._ids)),
+            "from": self._user(user_id),
+            "chat_instance": str(user_id),
+            "data": data,
+            "message": {
+                "message_id": next(self._ids),
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "from": {"id": 42, "is_bot": True, "first_name": "Bench"},
+                "text": "menu",
+            },
+        }}
+
+class QueryCounter:
+    """Число SQL-запросов, выполненных в контексте текущего апдейта"""
+
+    def __init__(self, engine):
+        from sqlalchemy import event
+        self._current = contextvars.ContextVar("bench_queries", default=None)
+        self.total = 0
+        event.listen(engine.sync_engine, "before_cursor_execute", self._on_execute)
+
+    def _on_execute(self, conn, cursor, statement, parameters, context, executemany):
+        self.total += 1
+        counter = self._current.get()
+        if counter is not None:
+            counter[0] += 1
+
+    def start(self):
+        counter = [0]
+        self._current.set(counter)
+        return counter
+
+async def seed_users(db, user_ids):
+    """Пользователи с балансом и языком — сценарий сразу попадает в главное меню"""
+    from sqlalchemy import update
+    from db import User
+    for user_id in user_ids:
+        await db.get_user(user_id)
+    async with db.async_session() as session:
+        async with session.begin():
+            await session.execute(
+                update(User).where(User.user_id.in_(user_ids))
+                .values(balance=START_BALANCE, lang="ru")
+                .execution_options(synchronize_session=False)
+            )
+    for user_id in user_ids:
+        db.invalidate_user(user_id)
+
+async def run(args):
+    """Возвращает отчёт и имена запросов с полным сканированием"""
+    from aiogram.types import Update
+    import bot as app
+
+    FakeSession = make_fake_session_class()
+    session = FakeSession(latency=args.api_latency_ms / 1000)
+    # Middleware сессии (счётчик вызовов API) переносятся в фальшивую сессию
+    session.middleware = app.bot.session.middleware
+    app.bot.session = session
+
+    db = app.db
+    await db.init()
+    # Стенд — единственная реплика: тиражи открывает сам, без выбора лидера
+    app.draw_registry.create = True
+    queries = QueryCounter(db.engine)
+    factory = UpdateFactory()
+    first_user = 10_000_000
+    user_ids = list(range(first_user, first_user + args.users))
+    await seed_users(db, user_ids)
+
+    latencies = defaultdict(list)
+    step_queries = defaultdict(list)
+    errors = Counter()
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def feed(user_id: int, step: str):
+        data = factory.command(user_id, "/start") if step == "start" else factory.callback(user_id, step)
+        counter = queries.start()
+        started = time.perf_counter()
+        try:
+            await app.dp.feed_update(app.bot, Update(**data))
+        except Exception as e:
+            errors[f"{step}: {type(e).__name__}"] += 1
+        latencies[step].append(time.perf_counter() - started)
+        step_queries[step].append(counter[0])
+
+    async def scenario(user_id: int):
+        async with semaphore:
+            for step in SCENARIO:
+                # Отдельный контекст на апдейт, как у задач поллинга
+                await asyncio.create_task(feed(user_id, step))
+
+    started = time.perf_counter()
+    for _ in range(args.rounds):
+        await asyncio.gather(*(scenario(user_id) for user_id in user_ids))
+    elapsed = time.perf_counter() - started
+    api_calls = sum(session.calls.values())
+
+    # Расчёт тиража и рассылка итогов
+    draw = app.draw_registry.current() or await app.draw_registry.get()
+    settle_queries_before = queries.total
+    settle_started = time.perf_counter()
+    await app.finish_and_notify_draw(draw)
+    # Уведомления победителям лежат в outbox — стенд отправляет их сам, как воркер лидера
+    await app.outbox_worker.drain()
+    settle_elapsed = time.perf_counter() - settle_started
+    settle_queries = queries.total - settle_queries_before
+    settle_stats = app.settlement_stats[-1] if app.settlement_stats else {}
+
+    total_updates = sum(len(v) for v in latencies.values())
+    all_latencies = [x for v in latencies.values() for x in v]
+    all_queries = [x for v in step_queries.values() for x in v]
+    lines = [
+        f"bench {datetime.utcnow():%Y-%m-%d %H:%M:%S} UTC",
+        f"database: {args.database_url}",
+        f"users={args.users} concurrency={args.concurrency} rounds={args.rounds} api_latency_ms={args.api_latency_ms}",
+        "",
+        f"updates: {total_updates} in {elapsed:.2f} s -> {total_updates / elapsed:.1f} updates/s",
+        f"latency p50={percentile(all_latencies, 0.5) * 1000:.1f} ms p99={percentile(all_latencies, 0.99) * 1000:.1f} ms",
+        f"db queries/update: {sum(all_queries) / max(1, total_updates):.2f}",
+        f"api calls/update: {api_calls / max(1, total_updates):.2f}",
+        "",
+        f"{'step':<15}{'count':>7}{'p50_ms':>10}{'p99_ms':>10}{'queries':>9}",
+    ]
+    for step in SCENARIO:
+        values = latencies[step]
+        lines.append(
+            f"{step:<15}{len(values):>7}{percentile(values, 0.5) * 1000:>10.1f}"
+            f"{percentile(values, 0.99) * 1000:>10.1f}{sum(step_queries[step]) / max(1, len(values)):>9.2f}"
+        )
+    lines += [
+        "",
+        f"settlement: draw={draw.code} participants={settle_stats.get('participants', 0)} "
+        f"settle={settle_stats.get('seconds', 0) * 1000:.1f} ms total_with_notify={settle_elapsed * 1000:.1f} ms "
+        f"queries={settle_queries} delivered={settle_stats.get('delivered', 0)} failed={settle_stats.get('failed', 0)}",
+        "api calls: " + ", ".join(f"{name}={count}" for name, count in session.calls.most_common()),
+    ]
+    if errors:
+        lines.append("errors: " + ", ".join(f"{name}={count}" for name, count in errors.most_common()))
+    lines += ["", "query plans:"]
+    full_scans = []
+    for name, plan in (await db.explain_draw_queries()).items():
+        full_scan = "Seq Scan" in plan or any(
+            line.strip().startswith("SCAN") and "USING" not in line for line in plan.splitlines())
+        if full_scan:
+            full_scans.append(name)
+        lines.append(f"  {name}{' (FULL SCAN)' if full_scan else ''}: " + plan.replace("\n", " | "))
+    await db.engine.dispose()
+    return "\n".join(lines), full_scans
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Нагрузочный стенд бота")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--rounds", type=int, default=1)
+    parser.add_argument("--api-latency-ms", type=float, default=0.0, help="имитация задержки Telegram API")
+    parser.add_argument("--database-url", default=None,
+                        help="по умолчанию — временная база SQLite (aiosqlite)")
+    parser.add_argument("--output", default=None, help="дописать отчёт в файл")
+    parser.add_argument("--check-plans", action="store_true",
+                        help="код выхода 1, если запрос к draws/draw_entries идёт полным сканированием")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    tmpdir = None
+    if args.database_url is None:
+        tmpdir = tempfile.TemporaryDirectory()
+        args.database_url = f"sqlite+aiosqlite:///{os.path.join(tmpdir.name, 'bench.db')}"
+    os.environ["DATABASE_URL"] = args.database_url
+    report, full_scans = asyncio.run(run(args))
+    print(report)
+    if args.output:
+        with open(args.output, "a", encoding="utf-8") as f:
+            f.write(report + "\n\n")
+    if tmpdir is not None:
+        tmpdir.cleanup()
+    if args.check_plans and full_scans:
+        print("full scan: " + ", ".join(full_scans), file=sys.stderr)
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
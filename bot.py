@@ -1,27 +1,54 @@
 import asyncio
+import html
 import logging
+import signal
 from aiogram import Bot, Dispatcher, types, F
 from aiogram.filters import CommandStart, Command, CommandObject
 from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup, BotCommand
-from aiogram.utils.keyboard import InlineKeyboardBuilder
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.context import FSMContext
 from uuid import uuid4
 from typing import Dict, Optional
 from cryptopay import CryptoPay
 import random
-from db import AsyncDatabase, User
+from db import AsyncDatabase, User, LedgerEntry, DrawClosedError, BroadcastTakenOverError
+from draws import DrawRegistry, NoActiveDrawError
+from leader import LeaderElector
+from fsm_storage import DatabaseStorage
+from i18n import Translations
+from message_tracker import MessageTracker, MessageTrackerMiddleware, content_hash, STICKER, FINAL, MENU
 import os
 from dotenv import load_dotenv
 from datetime import datetime, timedelta, timezone
 from aiogram.exceptions import TelegramBadRequest
 import string
+import time
+import json
+from collections import deque
+from settlement import compute_prizes
+from broadcast import Broadcaster, BroadcastStats
+from metrics import (
+    REGISTRY, Counter, Histogram, MetricsMiddleware, ApiCallCounter, instrument_engine, start_metrics_server,
+)
+from profiler import QueryProfiler
+from webhook import start_webhook_server, check_secret_token
+from outbox import OutboxWorker, text_message, sticker_message
 
 load_dotenv()
-db = AsyncDatabase(os.getenv("DATABASE_URL"))
+# Кэш пользователей в памяти процесса (USER_CACHE_SIZE, например 10000). Реплики не
+# сбрасывают кэш друг друга — включать только при одной реплике. Балансы всё равно
+# меняются условными UPDATE в БД, кэш влияет лишь на показ
+db = AsyncDatabase(
+    os.getenv("DATABASE_URL"),
+    user_cache_size=int(os.getenv("USER_CACHE_SIZE", "0")),
+    user_cache_ttl=float(os.getenv("USER_CACHE_TTL", "60")),
+)
 
-# Настройка логгирования
-logging.basicConfig(level=logging.INFO)
+# Настройка логгирования (LOG_LEVEL=DEBUG — подробный вывод)
+logging.basicConfig(
+    level=os.getenv("LOG_LEVEL", "INFO").upper(),
+    format="%(asctime)s %(levelname)s %(name)s %(message)s",
+)
 logger = logging.getLogger(__name__)
 
 # Конфигурация
@@ -29,13 +56,146 @@ API_TOKEN = os.getenv('API_TOKEN')
 CRYPTOPAY_TOKEN = os.getenv('CRYPTOPAY_TOKEN')
 
 bot = Bot(token=API_TOKEN, parse_mode='HTML')
-dp = Dispatcher()
+# Состояния FSM хранятся в БД: переживают перезапуск и видны всем репликам.
+# FSM_CACHE_TTL — сколько секунд реплика доверяет своему кэшу состояний
+# (для одной реплики можно ставить больше, кэш у неё всегда актуален)
+dp = Dispatcher(storage=DatabaseStorage(
+    db,
+    ttl=float(os.getenv("FSM_STATE_TTL", "86400")),
+    cache_ttl=float(os.getenv("FSM_CACHE_TTL", "2")),
+))
 
-# Инициализация CryptoPay
-cryptopay = CryptoPay(token=CRYPTOPAY_TOKEN)
+# Метрики: задержка обработчиков, сессии БД и вызовы API на апдейт.
+# Метки — только зарегистрированные команды и callback_data, остальное — other
+dp.update.outer_middleware(MetricsMiddleware(
+    commands=["start", "help", "balance", "deposit", "withdraw", "play", "rules", "referral",
+              "cachestats", "dbstats"],
+    callbacks=["play", "agree_lottery", "back_to_play", "back_to_main", "buy_1", "buy_3", "buy_10",
+               "balance", "deposit", "withdraw", "promo", "rules", "rules_next", "rules_prev",
+               "referral", "add10", "lottery_back_to_main", "change_lang", "lang_ru", "lang_en",
+               "second_chance_test", "attraction_winner_test"],
+    callback_prefixes=["check_"],
+))
+bot.session.middleware(ApiCallCounter())
+
+# Последнее сообщение бота в каждом чате: править его или отправлять новое
+message_tracker = MessageTracker(maxsize=int(os.getenv("MESSAGE_TRACKER_SIZE", "100000")))
+bot.session.middleware(MessageTrackerMiddleware(message_tracker))
+instrument_engine(db.engine)
+
+# Профилирование SQL (DB_PROFILE=1): статистика по запросам в /dbstats, медленные — в лог
+query_profiler = None
+if os.getenv("DB_PROFILE", "").lower() in ("1", "true", "yes"):
+    query_profiler = QueryProfiler(slow_query_ms=float(os.getenv("DB_SLOW_QUERY_MS", "100"))).attach(db.engine)
+
+# Инициализация CryptoPay (одна сессия с пулом соединений на весь процесс)
+cryptopay = CryptoPay(
+    token=CRYPTOPAY_TOKEN,
+    limit=int(os.getenv("CRYPTOPAY_POOL_LIMIT", "100")),
+    limit_per_host=int(os.getenv("CRYPTOPAY_POOL_PER_HOST", "20")),
+    keepalive_timeout=float(os.getenv("CRYPTOPAY_KEEPALIVE", "30")),
+)
+
+# Кэш пользователей и задержки CryptoPay — в /metrics
+@REGISTRY.collector
+def collect_service_stats():
+    cache = db.cache_stats()
+    families = []
+    if cache.get("enabled"):
+        families.append(("bot_user_cache_events_total", "counter", "User cache hits/misses/evictions", [
+            ({"event": "hit"}, cache["hits"]),
+            ({"event": "miss"}, cache["misses"]),
+            ({"event": "eviction"}, cache["evictions"]),
+        ]))
+        families.append(("bot_user_cache_size", "gauge", "Users in cache", [({}, cache["size"])]))
+    latency = cryptopay.latency_stats()
+    families.append(("cryptopay_requests_total", "counter", "CryptoPay API requests", [
+        ({"endpoint": endpoint}, stats["count"]) for endpoint, stats in latency.items()
+    ]))
+    families.append(("cryptopay_request_errors_total", "counter", "Failed CryptoPay API requests", [
+        ({"endpoint": endpoint}, stats["errors"]) for endpoint, stats in latency.items()
+    ]))
+    families.append(("cryptopay_request_seconds_sum", "counter", "Total CryptoPay API latency", [
+        ({"endpoint": endpoint}, cryptopay.metrics[endpoint]["total"]) for endpoint in latency
+    ]))
+    return families
 
 ADMIN_ID = int(os.getenv('ADMIN_ID'))  # Замените на свой Telegram user_id
 
+# Рассылки: общий лимит ~30 сообщений/с у Telegram, берём с запасом
+broadcaster = Broadcaster(
+    bot,
+    rate=float(os.getenv("BROADCAST_RATE", "25")),
+    concurrency=int(os.getenv("BROADCAST_CONCURRENCY", "20")),
+)
+
+async def send_outbox_message(chat_id: int, message_type: str, payload: dict):
+    if message_type == "sticker":
+        await bot.send_sticker(chat_id, payload["sticker"])
+        return
+    markup = payload.get("reply_markup")
+    sent = await bot.send_message(
+        chat_id, payload["text"], reply_markup=InlineKeyboardMarkup(**markup) if markup else None
+    )
+    if payload.get("final"):
+        message_tracker.mark_final(sent)
+
+outbox_messages = REGISTRY.register(Counter(
+    "bot_outbox_messages_total", "Outbox notifications by kind and status", ["kind", "status"]))
+
+# Уведомления о зачислениях, выводах и итогах тиражей: outbox в БД, отправка — в реплике-лидере.
+# OUTBOX_RETENTION_DAYS — сколько дней хранить недоставленные (failed/blocked) сообщения
+outbox_worker = OutboxWorker(
+    db, broadcaster, send_outbox_message,
+    batch_size=int(os.getenv("OUTBOX_BATCH_SIZE", "200")),
+    max_attempts=int(os.getenv("OUTBOX_MAX_ATTEMPTS", "5")),
+    poll_interval=float(os.getenv("OUTBOX_POLL_INTERVAL", "1")),
+    max_poll_interval=float(os.getenv("OUTBOX_MAX_POLL_INTERVAL", "15")),
+    retention=float(os.getenv("OUTBOX_RETENTION_DAYS", "7")) * 86400,
+    on_result=lambda kind, ref, status: on_outbox_result(kind, ref, status),
+)
+
+def on_outbox_result(kind: str, ref: Optional[str], status: str):
+    outbox_messages.inc(1, kind=kind, status=status)
+    if kind == "draw_result":
+        record_draw_notification(ref, status)
+
+# Ссылки на фоновые задачи, чтобы их не собрал сборщик мусора
+background_tasks = set()
+
+def spawn(coro):
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+class BotIdentity:
+    """Данные бота (getMe) и префикс реферальной ссылки; обновляются в фоне"""
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.me = None
+        self.ref_link_prefix = None
+
+    async def refresh(self):
+        self.me = await self.bot.get_me()
+        self.ref_link_prefix = f"https://t.me/{self.me.username}?start=ref_"
+
+    async def ref_link(self, user_id: int) -> str:
+        if self.ref_link_prefix is None:
+            await self.refresh()
+        return self.ref_link_prefix + str(user_id)
+
+    async def refresh_periodically(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.refresh()
+            except Exception as e:
+                logger.warning("bot identity refresh failed error=%s", e)
+
+bot_identity = BotIdentity(bot)
+
 # Состояния для FSM
 class UserStates(StatesGroup):
     waiting_for_deposit_amount = State()
@@ -131,6 +291,10 @@ translations = {
         "ru": "❌ Недостаточно средств для покупки {tickets} билетов.\nВаш баланс: {balance:.2f} TON",
         "en": "❌ Not enough funds to buy {tickets} tickets.\nYour balance: {balance:.2f} TON"
     },
+    "purchase_retry": {
+        "ru": "⏳ Тираж сейчас сменяется, билеты не куплены и деньги не списаны. Попробуйте ещё раз через несколько секунд.",
+        "en": "⏳ The draw is changing right now, no tickets were bought and nothing was charged. Please try again in a few seconds."
+    },
     "win_result": {
         "ru": "🎉 Вы приняли участие в лотерее и купили {tickets} билет(ов)!\nРезультат розыгрыша: Вы выиграли!\nСумма выигрыша: {win_amount} TON\nБаланс: {balance:.2f} TON",
         "en": "🎉 You participated in the lottery and bought {tickets} ticket(s)!\nResult: You won!\nWinnings: {win_amount} TON\nBalance: {balance:.2f} TON"
@@ -289,6 +453,10 @@ translations = {
         "ru": "Вывод {amount} TON",
         "en": "Withdrawal {amount} TON"
     },
+    "history_withdraw_refund": {
+        "ru": "Возврат неудачного вывода {amount} TON",
+        "en": "Failed withdrawal refund {amount} TON"
+    },
     "history_cashback": {
         "ru": "Кэшбек 3% за покупку билетов (выходные)",
         "en": "3% cashback for ticket purchase (weekend)"
@@ -415,38 +583,96 @@ translations = {
     },
 }
 
-def t(key, lang, **kwargs):
-    return translations[key][lang].format(**kwargs)
+# Переводы раскладываются по языкам при запуске; ошибки в словаре — сразу при импорте
+t = Translations(translations)
+
+# Клавиатуры без изменяемых данных собираются один раз на каждый язык
+def _build_keyboards(lang):
+    def button(key, callback_data):
+        return InlineKeyboardButton(text=t(key, lang), callback_data=callback_data)
+
+    def back(callback_data):
+        return [button("back", callback_data)]
+
+    main_rows = [
+        # Кнопка LOTTY TON сверху
+        [button("play", "play")],
+        # Остальные кнопки в два столбца
+        [button("balance", "balance"), button("promo_btn", "promo")],
+        [button("deposit", "deposit"), button("withdraw", "withdraw")],
+        [button("rules_btn", "rules"), button("referral", "referral")],
+        # Кнопка смены языка отдельной строкой
+        [button("change_lang", "change_lang")],
+    ]
+    admin_rows = [
+        [InlineKeyboardButton(text="🧪 Тестовая рассылка Второй шанс", callback_data="second_chance_test")],
+        [InlineKeyboardButton(text="🎉 Рассылка о выигрыше", callback_data="attraction_winner_test")],
+        [button("add10", "add10")],
+    ]
+    ticket_rows = [[button("ticket_1", "buy_1")], [button("ticket_3", "buy_3")], [button("ticket_10", "buy_10")]]
+    rows = {
+        "main_menu": main_rows,
+        "admin_menu": main_rows + admin_rows,
+        "play": [[button("agree_button", "agree_lottery"), button("back", "back_to_main")]],
+        "tickets": ticket_rows + [back("back_to_play")],
+        "tickets_main": ticket_rows + [back("back_to_main")],
+        "rules_page1": [[button("next", "rules_next")], back("back_to_main")],
+        "rules_page2": [[button("prev", "rules_prev")]],
+        "back_to_main": [back("back_to_main")],
+        "back_to_play": [back("back_to_play")],
+        # Кнопка "Испытать удачу" для перехода в главное меню
+        "try_luck": [[button("try_luck", "back_to_main")]],
+    }
+    return {name: InlineKeyboardMarkup(inline_keyboard=value) for name, value in rows.items()}
+
+KEYBOARDS = {lang: _build_keyboards(lang) for lang in t.langs}
+LANGUAGE_KEYBOARD = InlineKeyboardMarkup(inline_keyboard=[[
+    InlineKeyboardButton(text=t("button_ru", "ru"), callback_data="lang_ru"),
+    InlineKeyboardButton(text=t("button_en", "en"), callback_data="lang_en"),
+]])
+CHOOSE_LANGUAGE_TEXT = t("choose_language", "ru") + "\n" + t("choose_language", "en")
+
+def keyboard(name, lang):
+    return KEYBOARDS.get(lang, KEYBOARDS[t.default])[name]
 
 # Главное меню
 def main_menu(user_id=None, lang='ru'):
-    builder = InlineKeyboardBuilder()
-    # Кнопка LOTTY TON сверху
-    builder.row(
-        InlineKeyboardButton(text=t("play", lang), callback_data="play")
-    )
-    # Остальные кнопки в два столбца
-    builder.row(
-        InlineKeyboardButton(text=t("balance", lang), callback_data="balance"),
-        InlineKeyboardButton(text=t("promo_btn", lang), callback_data="promo")
-    )
-    builder.row(
-        InlineKeyboardButton(text=t("deposit", lang), callback_data="deposit"),
-        InlineKeyboardButton(text=t("withdraw", lang), callback_data="withdraw")
-    )
-    builder.row(
-        InlineKeyboardButton(text=t("rules_btn", lang), callback_data="rules"),
-        InlineKeyboardButton(text=t("referral", lang), callback_data="referral")
-    )
-    # Кнопка смены языка отдельной строкой
-    builder.row(
-        InlineKeyboardButton(text=t("change_lang", lang), callback_data="change_lang")
-    )
-    if user_id == ADMIN_ID:
-        builder.row(InlineKeyboardButton(text="🧪 Тестовая рассылка Второй шанс", callback_data="second_chance_test"))
-        builder.row(InlineKeyboardButton(text="🎉 Рассылка о выигрыше", callback_data="attraction_winner_test"))
-        builder.row(InlineKeyboardButton(text=t("add10", lang), callback_data="add10"))
-    return builder.as_markup()
+    return keyboard("admin_menu" if user_id == ADMIN_ID else "main_menu", lang)
+
+# Итоговые сообщения (пополнение, вывод, результат лотереи) узнаём по тексту,
+# только если сообщения нет в трекере (перезапуск, другая реплика)
+FINAL_PREFIXES = ("✅ Баланс пополнен на", "🎉 Вы приняли участие в лотерее",
+                  "✅ Balance topped up by", "🎉 You participated in the lottery")
+FINAL_SUFFIXES = ("TON отправлены в ваш CryptoBot-кошелёк!", "TON sent to your CryptoBot wallet!")
+
+def _message_kind(message: types.Message) -> str:
+    if message.sticker is not None:
+        return STICKER
+    text = message.text
+    if text and (text.startswith(FINAL_PREFIXES) or (text.startswith("✅ ") and text.endswith(FINAL_SUFFIXES))):
+        return FINAL
+    return MENU
+
+async def show_screen(callback: types.CallbackQuery, text: str, reply_markup=None, **kwargs):
+    """Показывает экран в сообщении с кнопкой: правит его или, если это стикер или
+    итог операции, отправляет новое. Правка без изменений пропускается."""
+    message = callback.message
+    last = message_tracker.get(message.chat.id, message.message_id)
+    if last is not None and message.sticker is None:
+        kind = last.kind
+    else:
+        kind = _message_kind(message)
+    if kind != MENU:
+        await message.answer(text, reply_markup=reply_markup, **kwargs)
+        return
+    if last is not None and last.content_hash == content_hash(text, reply_markup):
+        return
+    try:
+        await message.edit_text(text, reply_markup=reply_markup, **kwargs)
+    except TelegramBadRequest as e:
+        if "message is not modified" in str(e):
+            return
+        await message.answer(text, reply_markup=reply_markup, **kwargs)
 
 # Обработчики команд
 @dp.message(CommandStart())
@@ -462,26 +688,13 @@ async def start_command(message: types.Message, command: CommandObject):
             ref_id = None
     if ref_id and ref_id != message.from_user.id:
         # Сохраняем пригласившего
-        user.invited_by = ref_id
-        await db.update_user(user)
-        # Добавляем этого пользователя в список рефералов пригласившего
-        ref_user = await db.get_user(ref_id)
-        referrals = db.get_referrals(ref_user)
-        if message.from_user.id not in referrals:
-            referrals.append(message.from_user.id)
-            db.set_referrals(ref_user, referrals)
-            await db.update_user(ref_user)
+        if user.invited_by != ref_id:
+            await db.set_invited_by(user.user_id, ref_id)
+        # Добавляем пару в таблицу рефералов (повтор игнорируется)
+        await db.add_referral(ref_id, message.from_user.id)
     if not getattr(user, "lang", None):
         # Показываем выбор языка
-        builder = InlineKeyboardBuilder()
-        builder.row(
-            InlineKeyboardButton(text=translations["button_ru"]["ru"], callback_data="lang_ru"),
-            InlineKeyboardButton(text=translations["button_en"]["en"], callback_data="lang_en")
-        )
-        await message.answer(
-            translations["choose_language"]["ru"] + "\n" + translations["choose_language"]["en"],
-            reply_markup=builder.as_markup()
-        )
+        await message.answer(CHOOSE_LANGUAGE_TEXT, reply_markup=LANGUAGE_KEYBOARD)
         return
     await message.answer(
         t("start", user.lang, balance=user.balance, username=username),
@@ -493,125 +706,31 @@ async def start_command(message: types.Message, command: CommandObject):
 @dp.callback_query(F.data == "play")
 async def play_handler(callback: types.CallbackQuery):
     user = await db.get_user(callback.from_user.id)
-    builder = InlineKeyboardBuilder()
-    builder.add(InlineKeyboardButton(text=t("agree_button", user.lang), callback_data="agree_lottery"))
-    builder.add(InlineKeyboardButton(text=t("back", user.lang), callback_data="back_to_main"))
-    if (getattr(callback.message, 'sticker', None) or 
-        getattr(callback.message, 'content_type', None) == 'sticker' or 
-        (callback.message.text and (
-            # Русские варианты
-            "✅ Баланс пополнен на" in callback.message.text or 
-            "✅ " in callback.message.text and "TON отправлены в ваш CryptoBot-кошелёк!" in callback.message.text or
-            "🎉 Вы приняли участие в лотерее" in callback.message.text or
-            # Английские варианты
-            "✅ Balance topped up by" in callback.message.text or
-            "✅ " in callback.message.text and "TON sent to your CryptoBot wallet!" in callback.message.text or
-            "🎉 You participated in the lottery" in callback.message.text
-        ))):
-        await callback.message.answer(
-            t("agree_lottery", user.lang),
-            reply_markup=builder.as_markup()
-        )
-        return
-    await callback.message.edit_text(
-        t("agree_lottery", user.lang),
-        reply_markup=builder.as_markup()
-    )
+    await show_screen(callback, t("agree_lottery", user.lang), keyboard("play", user.lang))
 
 # После согласия — выбор количества билетов
 @dp.callback_query(F.data == "agree_lottery")
 async def agree_lottery_handler(callback: types.CallbackQuery):
     user = await db.get_user(callback.from_user.id)
-    builder = InlineKeyboardBuilder()
-    builder.row(InlineKeyboardButton(text=t("ticket_1", user.lang), callback_data="buy_1"))
-    builder.row(InlineKeyboardButton(text=t("ticket_3", user.lang), callback_data="buy_3"))
-    builder.row(InlineKeyboardButton(text=t("ticket_10", user.lang), callback_data="buy_10"))
-    builder.row(InlineKeyboardButton(text=t("back", user.lang), callback_data="back_to_play"))
-    if (getattr(callback.message, 'sticker', None) or 
-        getattr(callback.message, 'content_type', None) == 'sticker' or 
-        (callback.message.text and (
-            # Русские варианты
-            "✅ Баланс пополнен на" in callback.message.text or 
-            "✅ " in callback.message.text and "TON отправлены в ваш CryptoBot-кошелёк!" in callback.message.text or
-            "🎉 Вы приняли участие в лотерее" in callback.message.text or
-            # Английские варианты
-            "✅ Balance topped up by" in callback.message.text or
-            "✅ " in callback.message.text and "TON sent to your CryptoBot wallet!" in callback.message.text or
-            "🎉 You participated in the lottery" in callback.message.text
-        ))):
-        await callback.message.answer(
-            t("choose_tickets", user.lang),
-            reply_markup=builder.as_markup()
-        )
-        return
-    await callback.message.edit_text(
-        t("choose_tickets", user.lang),
-        reply_markup=builder.as_markup()
-    )
+    await show_screen(callback, t("choose_tickets", user.lang), keyboard("tickets", user.lang))
 
 @dp.callback_query(F.data == "back_to_play")
 async def back_to_play_handler(callback: types.CallbackQuery, state: FSMContext):
     await state.clear()
     user = await db.get_user(callback.from_user.id)
-    builder = InlineKeyboardBuilder()
-    builder.row(InlineKeyboardButton(text=t("ticket_1", user.lang), callback_data="buy_1"))
-    builder.row(InlineKeyboardButton(text=t("ticket_3", user.lang), callback_data="buy_3"))
-    builder.row(InlineKeyboardButton(text=t("ticket_10", user.lang), callback_data="buy_10"))
-    builder.row(InlineKeyboardButton(text=t("back", user.lang), callback_data="back_to_main"))
-    # Если последнее сообщение было стикером или содержит сообщения о выигрыше, отправляем новое
-    if (getattr(callback.message, 'sticker', None) or 
-        getattr(callback.message, 'content_type', None) == 'sticker' or
-        (callback.message.text and (
-            # Русские варианты
-            "🎉 Вы приняли участие в лотерее" in callback.message.text or
-            # Английские варианты
-            "🎉 You participated in the lottery" in callback.message.text
-        ))):
-        await callback.message.answer(
-            t("choose_tickets", user.lang),
-            reply_markup=builder.as_markup()
-        )
-        return
-    await callback.message.edit_text(
-        t("choose_tickets", user.lang),
-        reply_markup=builder.as_markup()
-    )
+    await show_screen(callback, t("choose_tickets", user.lang), keyboard("tickets_main", user.lang))
 
 @dp.callback_query(F.data == "back_to_main")
 async def back_to_main_handler(callback: types.CallbackQuery, state: FSMContext):
     await state.clear()
     user = await db.get_user(callback.from_user.id)
-    # Проверяем, содержит ли последнее сообщение стикер или финальные сообщения
-    if (getattr(callback.message, 'sticker', None) or 
-        getattr(callback.message, 'content_type', None) == 'sticker' or 
-        (callback.message.text and (
-            # Русские варианты
-            "✅ Баланс пополнен на" in callback.message.text or 
-            ("✅ " in callback.message.text and "TON отправлены в ваш CryptoBot-кошелёк!" in callback.message.text) or
-            "🎉 Вы приняли участие в лотерее" in callback.message.text or
-            # Английские варианты
-            "✅ Balance topped up by" in callback.message.text or
-            ("✅ " in callback.message.text and "TON sent to your CryptoBot wallet!" in callback.message.text) or
-            "🎉 You participated in the lottery" in callback.message.text
-        ))):
-        await callback.message.answer(
-            t("start", user.lang, balance=user.balance, username=callback.from_user.username or callback.from_user.first_name or "Пользователь"),
-            reply_markup=main_menu(callback.from_user.id, lang=user.lang),
-            disable_web_page_preview=True
-        )
-        return
-    try:
-        await callback.message.edit_text(
-            t("start", user.lang, balance=user.balance, username=callback.from_user.username or callback.from_user.first_name or "Пользователь"),
-            reply_markup=main_menu(callback.from_user.id, lang=user.lang),
-            disable_web_page_preview=True
-        )
-    except TelegramBadRequest:
-        await callback.message.answer(
-            t("start", user.lang, balance=user.balance, username=callback.from_user.username or callback.from_user.first_name or "Пользователь"),
-            reply_markup=main_menu(callback.from_user.id, lang=user.lang),
-            disable_web_page_preview=True
-        )
+    username = callback.from_user.username or callback.from_user.first_name or "Пользователь"
+    await show_screen(
+        callback,
+        t("start", user.lang, balance=user.balance, username=username),
+        main_menu(callback.from_user.id, lang=user.lang),
+        disable_web_page_preview=True
+    )
 
 # Покупка билетов и розыгрыш
 @dp.callback_query(F.data.in_(["buy_1", "buy_3", "buy_10"]))
@@ -624,101 +743,85 @@ async def buy_tickets_handler(callback: types.CallbackQuery):
         "buy_10": (10, 9.0)
     }
     tickets, price = ticket_map[callback.data]
-    if user.balance < price:
+    # Тираж берётся из памяти; списание, участие и журнал — одной транзакцией
+    try:
+        draw = await draw_registry.get()
+        try:
+            balance = await db.purchase_tickets(user_id, tickets, price, draw.id)
+        except DrawClosedError:
+            # Тираж закрылся во время покупки — покупаем в следующий
+            draw = await draw_registry.rollover(draw)
+            balance = await db.purchase_tickets(user_id, tickets, price, draw.id)
+    except (DrawClosedError, NoActiveDrawError) as e:
+        # Следующий тираж ещё не открыт (лидер сменяется) или закрылся и он — ничего не списано
+        logger.warning("purchase postponed user_id=%s error=%r", user_id, e)
+        await callback.message.edit_text(
+            t("purchase_retry", user.lang),
+            reply_markup=keyboard("back_to_play", user.lang)
+        )
+        return
+    if balance is None:
         await callback.message.edit_text(
             t("not_enough_funds", user.lang, tickets=tickets, balance=user.balance),
-            reply_markup=InlineKeyboardMarkup(inline_keyboard=[[
-                InlineKeyboardButton(text=t("back", user.lang), callback_data="back_to_main")
-            ]])
+            reply_markup=keyboard("back_to_main", user.lang)
         )
         return
-    # Списываем средства
-    user.balance -= price
-    user.ref_purchases = getattr(user, "ref_purchases", 0) + 1
-    await db.update_user(user)
-    # История операций
-    history = db.get_history(user)
-    history.append({"type": "game", "tickets": tickets, "amount": -price})
-    db.set_history(user, history)
-    await db.update_user(user)
-    # --- Привязываем к тиражу ---
-    draw = await db.get_active_draw()
-    if not draw:
-        draw = await db.create_new_draw(duration_minutes=1)
-    await db.add_entry(draw.id, user_id, tickets)
-    print(f"[DEBUG] add_entry: draw_id={draw.id}, user_id={user_id}, tickets={tickets}")
+    logger.debug("purchase draw_id=%s user_id=%s tickets=%s", draw.id, user_id, tickets)
     # --- Информируем пользователя о номере тиража ---
     await callback.message.edit_text(
         f"Вы купили {tickets} билет(ов) в тираже {draw.code}! Итоги через {int((draw.end_time - datetime.utcnow()).total_seconds() // 60)} минут. Удачи!",
-        reply_markup=InlineKeyboardMarkup(inline_keyboard=[[
-            InlineKeyboardButton(text=t("back", user.lang), callback_data="back_to_play")
-        ]])
+        reply_markup=keyboard("back_to_play", user.lang)
     )
 
 # Раздел баланса с историей
-@dp.callback_query(F.data == "balance")
-async def balance_handler(callback: types.CallbackQuery):
-    user = await db.get_user(callback.from_user.id)
-    history = db.get_history(user)
+def format_ledger_entry(entry: LedgerEntry, lang: str) -> str:
+    amount = ""
+    if entry.type == "game":
+        desc = t("history_game", lang, tickets=entry.tickets)
+        amount = entry.amount
+    elif entry.type == "win":
+        desc = t("history_win", lang, amount=f'{float(entry.amount or 0):.2f}')
+        amount = f'{float(entry.amount or 0):.2f}'
+    elif entry.type == "referral_bonus":
+        desc = t("history_referral_bonus", lang, ref_id=entry.ref_id)
+        amount = entry.amount
+    elif entry.type == "deposit":
+        desc = t("history_deposit", lang, amount=f'{float(entry.amount or 0):.2f}')
+        amount = f'{float(entry.amount or 0):.2f}'
+    elif entry.type == "withdraw":
+        desc = t("history_withdraw", lang, amount=f'{float(entry.amount or 0):.2f}')
+        amount = f'{float(entry.amount or 0):.2f}'
+    elif entry.type == "withdraw_refund":
+        desc = t("history_withdraw_refund", lang, amount=f'{float(entry.amount or 0):.2f}')
+        amount = f'{float(entry.amount or 0):.2f}'
+    elif entry.type == "cashback":
+        desc = t("history_cashback", lang)
+        amount = f'{float(entry.amount or 0):.2f}'
+    else:
+        desc = entry.type
+    if amount != "":
+        return f"• {desc} ({amount} TON)\n"
+    return f"• {desc}\n"
+
+async def build_history_text(user: User, limit: int = 10) -> str:
+    # Читаем только последние записи журнала
+    entries = await db.get_ledger(user.user_id, limit=limit)
     history_text = t("history", user.lang)
-    if history:
-        for h in history[-10:][::-1]:
-            desc = ""
-            amount = ""
-            if isinstance(h, dict):
-                if h.get("type") == "game":
-                    desc = t("history_game", user.lang, tickets=h.get("tickets"))
-                    amount = h.get("amount", "")
-                elif h.get("type") == "win":
-                    desc = t("history_win", user.lang, amount=f'{float(h.get("amount", 0)):.2f}')
-                    amount = f'{float(h.get("amount", 0)):.2f}'
-                elif h.get("type") == "referral_bonus":
-                    desc = t("history_referral_bonus", user.lang, ref_id=h.get("ref_id"))
-                    amount = h.get("amount", "")
-                elif h.get("type") == "deposit":
-                    desc = t("history_deposit", user.lang, amount=f'{float(h.get("amount", 0)):.2f}')
-                    amount = f'{float(h.get("amount", 0)):.2f}'
-                elif h.get("type") == "withdraw":
-                    desc = t("history_withdraw", user.lang, amount=f'{float(h.get("amount", 0)):.2f}')
-                    amount = f'{float(h.get("amount", 0)):.2f}'
-                elif h.get("type") == "cashback":
-                    desc = t("history_cashback", user.lang)
-                    amount = f'{float(h.get("amount", 0)):.2f}'
-                else:
-                    desc = str(h)
-            else:
-                desc = str(h)
-            if amount != "":
-                history_text += f"• {desc} ({amount} TON)\n"
-            else:
-                history_text += f"• {desc}\n"
+    if entries:
+        for entry in entries:
+            history_text += format_ledger_entry(entry, user.lang)
     else:
         history_text += t("no_history", user.lang)
-    # Если последнее сообщение было стикером или содержит ключевые фразы, отправляем новое сообщение
-    if (getattr(callback.message, 'sticker', None) or 
-        getattr(callback.message, 'content_type', None) == 'sticker' or 
-        (callback.message.text and (
-            # Русские варианты
-            "✅ Баланс пополнен на" in callback.message.text or 
-            ("✅ " in callback.message.text and "TON отправлены в ваш CryptoBot-кошелёк!" in callback.message.text) or
-            "🎉 Вы приняли участие в лотерее" in callback.message.text or
-            # Английские варианты
-            "✅ Balance topped up by" in callback.message.text or
-            ("✅ " in callback.message.text and "TON sent to your CryptoBot wallet!" in callback.message.text) or
-            "🎉 You participated in the lottery" in callback.message.text
-        ))):
-        await callback.message.answer(
-            t("balance_text", user.lang, balance=user.balance) + history_text,
-            reply_markup=InlineKeyboardMarkup(inline_keyboard=[[\
-                InlineKeyboardButton(text=t("back", user.lang), callback_data="back_to_main")
-            ]])
-        )
-        return
-    await callback.message.edit_text(
+    return history_text
+
+@dp.callback_query(F.data == "balance")
+async def balance_handler(callback: types.CallbackQuery):
+    user = await db.get_user(callback.from_user.id)
+    history_text = await build_history_text(user, limit=10)
+    await show_screen(
+        callback,
         t("balance_text", user.lang, balance=user.balance) + history_text,
-        reply_markup=InlineKeyboardMarkup(inline_keyboard=[[\
-            InlineKeyboardButton(text=t("back", user.lang), callback_data="back_to_main")
-        ]])
+        keyboard("back_to_main", user.lang)
     )
 
 # Раздел пополнения
@@ -728,9 +831,7 @@ async def deposit_handler(callback: types.CallbackQuery, state: FSMContext):
     await state.set_state(UserStates.waiting_for_deposit_amount)
     await callback.message.edit_text(
         t("deposit_menu", user.lang),
-        reply_markup=InlineKeyboardMarkup(inline_keyboard=[[
-            InlineKeyboardButton(text=t("back", user.lang), callback_data="back_to_main")
-        ]])
+        reply_markup=keyboard("back_to_main", user.lang)
     )
 
 @dp.message(UserStates.waiting_for_deposit_amount, F.text.regexp(r"^\d+(\.\d+)?$"))
@@ -745,24 +846,25 @@ async def process_deposit(message: types.Message, state: FSMContext):
     ])
 
     if amount >= 1:
-        invoice = await cryptopay.create_invoice(amount=amount, description=f"Пополнение баланса для {user_id}")
+        invoice = await cryptopay.create_invoice(
+            amount=amount, description=f"Пополнение баланса для {user_id}", payload=str(user_id)
+        )
         if invoice and invoice.get("ok"):
             result = invoice["result"]
             pay_url = result["pay_url"]
             invoice_id = result["invoice_id"]
+            # Счёт сохраняется в БД — оплату зачислит фоновая сверка
+            await db.add_invoice(int(invoice_id), user_id, amount)
+            invoice_created.set()
             menu_markup.inline_keyboard[0][0].url = pay_url
             menu_markup.inline_keyboard[1][0].callback_data = f"check_{invoice_id}"
             await message.answer(t("deposit_pay", user.lang, amount=amount), reply_markup=menu_markup)
             await state.clear()
         else:
-            await message.answer(t("deposit_error", user.lang), reply_markup=InlineKeyboardMarkup(inline_keyboard=[[
-                InlineKeyboardButton(text=t("back", user.lang), callback_data="back_to_main")
-            ]]))
+            await message.answer(t("deposit_error", user.lang), reply_markup=keyboard("back_to_main", user.lang))
             await state.clear()
     else:
-        await message.answer(t("deposit_min", user.lang), reply_markup=InlineKeyboardMarkup(inline_keyboard=[[
-            InlineKeyboardButton(text=t("back", user.lang), callback_data="back_to_main")
-        ]]))
+        await message.answer(t("deposit_min", user.lang), reply_markup=keyboard("back_to_main", user.lang))
         await state.clear()
 
 # Раздел вывода
@@ -770,9 +872,7 @@ async def process_deposit(message: types.Message, state: FSMContext):
 async def withdraw_handler(callback: types.CallbackQuery, state: FSMContext):
     user = await db.get_user(callback.from_user.id)
     await state.set_state(UserStates.waiting_for_withdraw_amount)
-    menu_markup = InlineKeyboardMarkup(inline_keyboard=[[
-        InlineKeyboardButton(text=t("back", user.lang), callback_data="back_to_main")
-    ]])
+    menu_markup = keyboard("back_to_main", user.lang)
     if user.balance < 1:
         await callback.message.edit_text(t("withdraw_min", user.lang), reply_markup=menu_markup)
         await state.clear()
@@ -788,23 +888,16 @@ async def process_withdrawal(message: types.Message, state: FSMContext):
     amount = float(message.text)
     user_id = message.from_user.id
     user = await db.get_user(user_id)
-    menu_markup = InlineKeyboardMarkup(inline_keyboard=[[
-        InlineKeyboardButton(text=t("back", user.lang), callback_data="back_to_main")
-    ]])
+    menu_markup = keyboard("back_to_main", user.lang)
 
     if user.balance >= amount:
-        success = await db.process_withdrawal(user_id, amount, cryptopay)
+        # Списание — в БД до перевода; стикер и подтверждение уходят в outbox после перевода
+        success = await db.process_withdrawal(
+            user_id, amount, cryptopay,
+            messages=withdraw_messages(user_id, user.lang, amount),
+        )
         if success:
-            history = db.get_history(user)
-            history.append({"type": "withdraw", "amount": amount, "desc": f"Вывод в CryptoBot ({amount} TON)"})
-            db.set_history(user, history)
-            await db.update_user(user)
-            # Отправляем стикер перед сообщением
-            sticker_message = await message.answer_sticker("CAACAgIAAxkBAAEOthVoUFVeKz06CYbsn5GfPido8X8ftAACAQEAAladvQoivp8OuMLmNDYE")
-            await message.answer(t("withdraw_success", user.lang, amount=amount), reply_markup=menu_markup)
-            # Сохраняем ID стикера для возможного удаления
-            user.last_sticker_id = sticker_message.message_id
-            await db.update_user(user)
+            outbox_worker.wake()
         else:
             await message.answer(t("withdraw_error", user.lang), reply_markup=menu_markup)
     else:
@@ -818,9 +911,7 @@ async def promo_handler(callback: types.CallbackQuery):
     user = await db.get_user(callback.from_user.id)
     await callback.message.edit_text(
         t("promo_text", user.lang),
-        reply_markup=InlineKeyboardMarkup(inline_keyboard=[[
-            InlineKeyboardButton(text=t("back", user.lang), callback_data="back_to_main")
-        ]])
+        reply_markup=keyboard("back_to_main", user.lang)
     )
 
 # Раздел правил
@@ -828,12 +919,9 @@ async def promo_handler(callback: types.CallbackQuery):
 async def rules_handler(callback: types.CallbackQuery):
     user = await db.get_user(callback.from_user.id)
     lang = user.lang
-    builder = InlineKeyboardBuilder()
-    builder.row(InlineKeyboardButton(text=t("next", lang), callback_data="rules_next"))
-    builder.row(InlineKeyboardButton(text=t("back", lang), callback_data="back_to_main"))
     await callback.message.edit_text(
         t("rules_page1", lang),
-        reply_markup=builder.as_markup(),
+        reply_markup=keyboard("rules_page1", lang),
         disable_web_page_preview=True
     )
 
@@ -841,11 +929,9 @@ async def rules_handler(callback: types.CallbackQuery):
 async def rules_next_handler(callback: types.CallbackQuery):
     user = await db.get_user(callback.from_user.id)
     lang = user.lang
-    builder = InlineKeyboardBuilder()
-    builder.row(InlineKeyboardButton(text=t("prev", lang), callback_data="rules_prev"))
     await callback.message.edit_text(
         t("rules_page2", lang),
-        reply_markup=builder.as_markup(),
+        reply_markup=keyboard("rules_page2", lang),
         disable_web_page_preview=True
     )
 
@@ -853,36 +939,23 @@ async def rules_next_handler(callback: types.CallbackQuery):
 async def rules_prev_handler(callback: types.CallbackQuery):
     user = await db.get_user(callback.from_user.id)
     lang = user.lang
-    builder = InlineKeyboardBuilder()
-    builder.row(InlineKeyboardButton(text=t("next", lang), callback_data="rules_next"))
-    builder.row(InlineKeyboardButton(text=t("back", lang), callback_data="back_to_main"))
     await callback.message.edit_text(
         t("rules_page1", lang),
-        reply_markup=builder.as_markup(),
+        reply_markup=keyboard("rules_page1", lang),
         disable_web_page_preview=True
     )
 
 # Реферальная программа
-@dp.callback_query(F.data == "referral")
-async def referral_handler(callback: types.CallbackQuery):
-    user_id = callback.from_user.id
-    user = await db.get_user(user_id)
-    referrals = db.get_referrals(user)
-    total_referrals = len(referrals)
-    active_referrals = []
-    for rid in referrals:
-        ref_user = await db.get_user(rid)
-        if getattr(ref_user, "ref_purchases", 0) > 0:
-            active_referrals.append(rid)
-    total_active = len(active_referrals)
-    earned = round(getattr(user, "earned", 0.0), 2)
-    last_active = active_referrals[-3:]
-    total_purchases = 0
-    for rid in referrals:
-        ref_user = await db.get_user(rid)
-        total_purchases += getattr(ref_user, "ref_purchases", 0)
+async def build_referral_text(user: User) -> str:
+    user_id = user.user_id
     lang = user.lang
-    ref_link = f"https://t.me/{(await bot.get_me()).username}?start=ref_{user_id}"
+    stats = await db.get_referral_stats(user_id)
+    total_referrals = stats["total"]
+    total_active = stats["active"]
+    earned = round(getattr(user, "earned", 0.0), 2)
+    last_active = stats["last_active"]
+    total_purchases = stats["total_purchases"]
+    ref_link = await bot_identity.ref_link(user_id)
     ref_percent = int(get_ref_percent(total_referrals) * 100)
     next_level, next_percent = get_next_ref_level(total_referrals)
     max_percent = 25
@@ -940,11 +1013,16 @@ async def referral_handler(callback: types.CallbackQuery):
         for rid in last_active:
             text += f"- {rid}\n"
     text += t("referral_bonus_info", lang, percent=ref_percent)
+    return text
+
+@dp.callback_query(F.data == "referral")
+async def referral_handler(callback: types.CallbackQuery):
+    user = await db.get_user(callback.from_user.id)
+    lang = user.lang
+    text = await build_referral_text(user)
     await callback.message.edit_text(
         text,
-        reply_markup=InlineKeyboardMarkup(inline_keyboard=[[ 
-            InlineKeyboardButton(text=t("back", lang), callback_data="back_to_main")
-        ]])
+        reply_markup=keyboard("back_to_main", lang)
     )
 
 # Обработчик начисления 10 TON (только для админа)
@@ -952,8 +1030,7 @@ async def referral_handler(callback: types.CallbackQuery):
 async def add10_handler(callback: types.CallbackQuery):
     if callback.from_user.id == ADMIN_ID:
         user = await db.get_user(callback.from_user.id)
-        user.balance += 10
-        await db.update_user(user)
+        await db.change_balance(user.user_id, 10)
         await callback.message.edit_text(
             "✅ На ваш баланс начислено 10 TON!",
             reply_markup=main_menu(callback.from_user.id, lang=user.lang)
@@ -974,32 +1051,7 @@ async def lottery_back_to_main_handler(callback: types.CallbackQuery):
 @dp.callback_query(F.data == "change_lang")
 async def change_lang_handler(callback: types.CallbackQuery):
     user = await db.get_user(callback.from_user.id)
-    builder = InlineKeyboardBuilder()
-    builder.row(
-        InlineKeyboardButton(text="Русский", callback_data="lang_ru"),
-        InlineKeyboardButton(text="English", callback_data="lang_en")
-    )
-    if (getattr(callback.message, 'sticker', None) or 
-        getattr(callback.message, 'content_type', None) == 'sticker' or 
-        (callback.message.text and (
-            # Русские варианты
-            "✅ Баланс пополнен на" in callback.message.text or 
-            "✅ " in callback.message.text and "TON отправлены в ваш CryptoBot-кошелёк!" in callback.message.text or
-            "🎉 Вы приняли участие в лотерее" in callback.message.text or
-            # Английские варианты
-            "✅ Balance topped up by" in callback.message.text or
-            "✅ " in callback.message.text and "TON sent to your CryptoBot wallet!" in callback.message.text or
-            "🎉 You participated in the lottery" in callback.message.text
-        ))):
-        await callback.message.answer(
-            t("choose_language", user.lang),
-            reply_markup=builder.as_markup()
-        )
-        return
-    await callback.message.edit_text(
-        t("choose_language", user.lang),
-        reply_markup=builder.as_markup()
-    )
+    await show_screen(callback, t("choose_language", user.lang), LANGUAGE_KEYBOARD)
     await callback.answer()
 
 @dp.callback_query(F.data.in_(["lang_ru", "lang_en"]))
@@ -1018,37 +1070,117 @@ async def set_language(callback: types.CallbackQuery):
         await callback.answer(t("language_changed", lang), show_alert=True)
     await callback.answer()
 
+# Текст рассылки о выигрыше
+ATTRACTION_TEXT = {
+    "ru": "🎉 ПОЗДРАВЛЯЕМ ПОБЕДИТЕЛЯ!\n\nПользователь с ID {winner_id} только что выиграл {win_amount} TON в лотерее LOTTY TON! 🎊\n\nЭто может быть и вы! Присоединяйтесь к игре и испытайте свою удачу! 🍀\n\nLOTTY TON — честная лотерея с мгновенными выплатами через CryptoBot!",
+    "en": "🎉 CONGRATULATIONS TO THE WINNER!\n\nUser with ID {winner_id} just won {win_amount} TON in the LOTTY TON lottery! 🎊\n\nThis could be you! Join the game and try your luck! 🍀\n\nLOTTY TON — fair lottery with instant payouts via CryptoBot!"
+}
+
+def broadcast_texts(kind: str, params: dict) -> Dict[str, str]:
+    """Тексты рассылки на всех языках — готовятся один раз на рассылку"""
+    if kind == "second_chance":
+        return {lang: t("second_chance_winner", lang, winner_id=params["winner_id"]) for lang in ("ru", "en")}
+    if kind == "attraction":
+        return {lang: ATTRACTION_TEXT[lang].format(**params) for lang in ("ru", "en")}
+    raise ValueError(f"Unknown broadcast kind: {kind}")
+
+def try_luck_markups() -> Dict[str, InlineKeyboardMarkup]:
+    return {lang: keyboard("try_luck", lang) for lang in t.langs}
+
+async def broadcast_recipients(after_user_id=None):
+    # Потоково, только user_id и lang — память не растёт с числом пользователей
+    async for row in db.iter_users(columns=("user_id", "lang"), after_user_id=after_user_id):
+        yield row.user_id, row.lang or "ru"
+
+# Владелец рассылки подаёт пульс раз в BROADCAST_HEARTBEAT секунд; рассылку без пульса
+# дольше BROADCAST_STALE_AFTER секунд продолжает лидер (resume_broadcasts)
+BROADCAST_HEARTBEAT = float(os.getenv("BROADCAST_HEARTBEAT", "30"))
+BROADCAST_STALE_AFTER = float(os.getenv("BROADCAST_STALE_AFTER", "120"))
+# Рассылки, которые идут в этом процессе
+running_broadcasts = set()
+
+async def run_broadcast(name: str, kind: str, params: dict, report_chat_id: Optional[int] = None):
+    """Запускает рассылку или продолжает её с последней сохранённой позиции"""
+    if name in running_broadcasts:
+        return None
+    running_broadcasts.add(name)
+    try:
+        return await _run_broadcast(name, kind, params, report_chat_id)
+    except BroadcastTakenOverError:
+        logger.warning(f"Broadcast {name} was taken over by another process, stopping")
+        return None
+    finally:
+        running_broadcasts.discard(name)
+
+async def _heartbeat_broadcast(name: str, holder: str):
+    while True:
+        await asyncio.sleep(BROADCAST_HEARTBEAT)
+        try:
+            await db.touch_broadcast(name, holder)
+        except BroadcastTakenOverError:
+            # Следующая контрольная точка остановит рассылку
+            return
+        except Exception as e:
+            logger.warning(f"Broadcast {name} heartbeat failed: {e}")
+
+async def _run_broadcast(name: str, kind: str, params: dict, report_chat_id: Optional[int]):
+    holder = leader.holder
+    record = await db.claim_broadcast(name, kind, params, holder, BROADCAST_STALE_AFTER)
+    if record is None:
+        logger.info(f"Broadcast {name} is finished or running elsewhere, skipping")
+        return None
+    texts = broadcast_texts(record.kind, json.loads(record.params))
+    markups = try_luck_markups()
+    position = {"last_user_id": record.last_user_id}
+    stats = BroadcastStats(delivered=record.delivered or 0, blocked=record.blocked or 0, failed=record.failed or 0)
+    progress_message = None
+    if report_chat_id:
+        progress_message = await bot.send_message(report_chat_id, f"📣 Рассылка {name} запущена")
+
+    async def checkpoint(last_user_id, stats):
+        position["last_user_id"] = last_user_id
+        await db.save_broadcast_progress(name, holder, last_user_id, stats.delivered, stats.blocked, stats.failed)
+
+    async def on_progress(stats):
+        await progress_message.edit_text(f"📣 Рассылка {name}: обработано {stats.processed}\n" + stats.report())
+
+    heartbeat = asyncio.create_task(_heartbeat_broadcast(name, holder))
+    try:
+        stats = await broadcaster.run(
+            broadcast_recipients(record.last_user_id),
+            lambda lang: (texts.get(lang, texts["ru"]), markups.get(lang, markups["ru"])),
+            stats=stats,
+            checkpoint=checkpoint,
+            on_progress=on_progress if progress_message else None,
+        )
+    finally:
+        heartbeat.cancel()
+    await db.save_broadcast_progress(name, holder, position["last_user_id"], stats.delivered, stats.blocked,
+                                     stats.failed, status='done')
+    logger.info(f"Broadcast {name} finished: delivered={stats.delivered} blocked={stats.blocked} failed={stats.failed}")
+    if report_chat_id:
+        await bot.send_message(report_chat_id, f"✅ Рассылка {name} завершена\n" + stats.report())
+    return stats
+
+async def resume_broadcasts():
+    """Продолжает рассылки, прерванные перезапуском; живые (с пульсом) run_broadcast пропустит"""
+    for record in await db.get_unfinished_broadcasts():
+        if record.name in running_broadcasts:
+            continue
+        logger.info(f"Checking unfinished broadcast {record.name} after user_id={record.last_user_id}")
+        spawn(run_broadcast(record.name, record.kind, json.loads(record.params), report_chat_id=ADMIN_ID))
+
 # Обработчик тестовой рассылки для администратора
 @dp.callback_query(F.data == "second_chance_test")
 async def second_chance_test_handler(callback: types.CallbackQuery):
     if callback.from_user.id != ADMIN_ID:
         await callback.answer("Нет доступа", show_alert=True)
         return
-    import random
     fake_id = str(random.randint(100000000, 999999999))
     winner_id_masked = fake_id[:-3] + "***"
-    # Получаем всех пользователей
-    async with db.async_session() as session:
-        from sqlalchemy import select
-        result = await session.execute(select(User))
-        users = result.scalars().all()
-    count = 0
-    for user in users:
-        lang = getattr(user, "lang", "ru")
-        try:
-            # Кнопка "Испытать удачу" для перехода в главное меню
-            builder = InlineKeyboardBuilder()
-            builder.row(InlineKeyboardButton(text=t("try_luck", lang), callback_data="back_to_main"))
-            
-            await bot.send_message(
-                user.user_id,
-                t("second_chance_winner", lang, winner_id=winner_id_masked),
-                reply_markup=builder.as_markup()
-            )
-            count += 1
-        except Exception as e:
-            continue
-    await callback.answer(f"Рассылка отправлена {count} пользователям", show_alert=True)
+    name = f"second_chance_test_{uuid4().hex[:8]}"
+    spawn(run_broadcast(name, "second_chance", {"winner_id": winner_id_masked}, report_chat_id=callback.from_user.id))
+    await callback.answer("Рассылка запущена", show_alert=True)
 
 # Обработчик рассылки о выигрыше для администратора
 @dp.callback_query(F.data == "attraction_winner_test")
@@ -1056,81 +1188,43 @@ async def attraction_winner_test_handler(callback: types.CallbackQuery):
     if callback.from_user.id != ADMIN_ID:
         await callback.answer("Нет доступа", show_alert=True)
         return
-    import random
     fake_id = str(random.randint(100000000, 999999999))
     winner_id_masked = fake_id[:-3] + "***"
     win_amount = random.randint(50, 1500)
-    # Получаем всех пользователей
-    async with db.async_session() as session:
-        from sqlalchemy import select
-        result = await session.execute(select(User))
-        users = result.scalars().all()
-    count = 0
-    for user in users:
-        lang = getattr(user, "lang", "ru")
-        try:
-            # Кнопка "Испытать удачу" для перехода в главное меню
-            builder = InlineKeyboardBuilder()
-            builder.row(InlineKeyboardButton(text=t("try_luck", lang), callback_data="back_to_main"))
-            
-            # Текст рассылки о выигрыше
-            attraction_text = {
-                "ru": f"🎉 ПОЗДРАВЛЯЕМ ПОБЕДИТЕЛЯ!\n\nПользователь с ID {winner_id_masked} только что выиграл {win_amount} TON в лотерее LOTTY TON! 🎊\n\nЭто может быть и вы! Присоединяйтесь к игре и испытайте свою удачу! 🍀\n\nLOTTY TON — честная лотерея с мгновенными выплатами через CryptoBot!",
-                "en": f"🎉 CONGRATULATIONS TO THE WINNER!\n\nUser with ID {winner_id_masked} just won {win_amount} TON in the LOTTY TON lottery! 🎊\n\nThis could be you! Join the game and try your luck! 🍀\n\nLOTTY TON — fair lottery with instant payouts via CryptoBot!"
-            }
-            
-            await bot.send_message(
-                user.user_id,
-                attraction_text[lang],
-                reply_markup=builder.as_markup()
-            )
-            count += 1
-        except Exception as e:
-            continue
-    await callback.answer(f"Рассылка о выигрыше отправлена {count} пользователям", show_alert=True)
+    name = f"attraction_test_{uuid4().hex[:8]}"
+    params = {"winner_id": winner_id_masked, "win_amount": win_amount}
+    spawn(run_broadcast(name, "attraction", params, report_chat_id=callback.from_user.id))
+    await callback.answer("Рассылка о выигрыше запущена", show_alert=True)
 
-# Обработчик проверки оплаты
+# Обработчик проверки оплаты — только локальная проверка, без запроса в CryptoPay
 @dp.callback_query(F.data.startswith("check_"))
 async def check_payment_handler(callback: types.CallbackQuery):
     user = await db.get_user(callback.from_user.id)
-    invoice_id = callback.data.split("_")[1]
-    invoice = await cryptopay.check_invoice(invoice_id)
+    try:
+        invoice_id = int(callback.data.split("_")[1])
+    except (IndexError, ValueError):
+        invoice_id = None
+    invoice = await db.get_invoice(invoice_id) if invoice_id else None
+    if invoice is None and invoice_id:
+        invoice = await import_invoice(invoice_id, callback.from_user.id)
     menu_markup = InlineKeyboardMarkup(inline_keyboard=[[
         InlineKeyboardButton(text="🔄 Проверить оплату", callback_data=f"check_{invoice_id}")],
         [InlineKeyboardButton(text=t("back", user.lang), callback_data="back_to_main")]
     ])
 
-    if invoice.get("ok") and invoice.get("result") and invoice["result"].get("items") and len(invoice["result"]["items"]) > 0:
-        invoice_data = invoice["result"]["items"][0]
-        status = invoice_data.get("status")
-        if status == "paid":
-            payload = invoice_data.get("payload")
-            if payload and payload != 'None':
-                try:
-                    user_id = int(payload)
-                except (ValueError, TypeError):
-                    user_id = callback.from_user.id
-            else:
-                user_id = callback.from_user.id
-            amount = float(invoice_data.get("amount", 0))
-            user = await db.get_user(user_id)
-            user.balance += amount
-            history = db.get_history(user)
-            history.append({"type": "deposit", "amount": amount, "desc": f"Пополнение через CryptoBot ({amount} TON)"})
-            db.set_history(user, history)
-            await db.update_user(user)
-            # Сначала отправляем стикер
-            await callback.message.answer_sticker("CAACAgIAAxkBAAEOvPloVUPLwmRLS0gSrDAzbXBqSoqZRgAC9wADVp29CgtyJB1I9A0wNgQ")
-            # Кнопка "‹ Назад"
-            menu_markup = InlineKeyboardMarkup(inline_keyboard=[[
-                InlineKeyboardButton(text=t("back", user.lang), callback_data="back_to_main")
-            ]])
-            await callback.message.answer(
-                t("check_payment_paid", user.lang, amount=amount),
-                reply_markup=menu_markup
-            )
-            return
-        elif status == "active":
+    if invoice is not None and invoice.user_id == callback.from_user.id:
+        if invoice.status == "paid":
+            # Зачисление и уведомление уже сделала сверка счетов
+            try:
+                edited = await callback.message.edit_text(
+                    t("check_payment_paid", user.lang, amount=invoice.amount),
+                    reply_markup=keyboard("back_to_main", user.lang)
+                )
+                if isinstance(edited, types.Message):
+                    message_tracker.mark_final(edited)
+            except TelegramBadRequest:
+                pass
+        elif invoice.status == "active":
             try:
                 await callback.message.edit_text(
                     t("check_payment_active", user.lang),
@@ -1141,7 +1235,7 @@ async def check_payment_handler(callback: types.CallbackQuery):
         else:
             try:
                 await callback.message.edit_text(
-                    t("check_payment_status", user.lang, status=status),
+                    t("check_payment_status", user.lang, status=invoice.status),
                     reply_markup=menu_markup
                 )
             except TelegramBadRequest:
@@ -1156,20 +1250,232 @@ async def check_payment_handler(callback: types.CallbackQuery):
             ])
         )
 
-# Запуск бота
-async def main():
+# --- Сверка счетов CryptoPay ---
+INVOICE_POLL_INTERVAL = float(os.getenv("INVOICE_POLL_INTERVAL", "5"))
+INVOICE_BATCH_SIZE = 100  # id в одном запросе getInvoices
+# Будит сверку, когда создан новый счёт
+invoice_created = asyncio.Event()
+
+# id, которые не нашлись в CryptoPay или принадлежат другому пользователю — повторно не спрашиваем
+unknown_invoice_ids = set()
+
+async def import_invoice(invoice_id: int, user_id: int):
+    """Счёт, созданный до появления таблицы invoices: находим в CryptoPay и сохраняем.
+
+    Зачисляется только активный счёт (через обычную сверку); уже оплаченный
+    сохраняется как paid без зачисления. Владелец подтверждается payload
+    (user_id) или описанием счёта.
+    """
+    if invoice_id in unknown_invoice_ids:
+        return None
+    data = await cryptopay.get_invoices([invoice_id])
+    if not data.get("ok") or not isinstance(data.get("result"), dict):
+        # Ошибка API — не запоминаем, пользователь может нажать ещё раз
+        return None
+    item = next((i for i in data["result"].get("items") or [] if int(i["invoice_id"]) == invoice_id), None)
+    owner_payload = item is not None and str(item.get("payload") or "") == str(user_id)
+    owner_description = item is not None and item.get("description") == f"Пополнение баланса для {user_id}"
+    if not (owner_payload or owner_description):
+        if len(unknown_invoice_ids) > 10000:
+            unknown_invoice_ids.clear()
+        unknown_invoice_ids.add(invoice_id)
+        return None
+    amount = float(item.get("amount", 0))
+    status = item.get("status")
+    if status == "paid":
+        # До таблицы invoices оплаченные счета зачислялись при каждом нажатии —
+        # было ли зачисление, неизвестно, поэтому сохраняем без зачисления
+        await db.add_invoice(invoice_id, user_id, amount, status="paid")
+        logger.warning(f"Imported paid invoice {invoice_id} of user {user_id} amount={amount} without credit, needs admin review")
+    elif status == "expired":
+        await db.add_invoice(invoice_id, user_id, amount, status="expired")
+        logger.info(f"Imported expired invoice {invoice_id} of user {user_id}")
+    else:
+        # Активный счёт зачислит сверка, как обычный
+        await db.add_invoice(invoice_id, user_id, amount)
+        logger.info(f"Imported invoice {invoice_id} of user {user_id} with status {status}")
+        invoice_created.set()
+    return await db.get_invoice(invoice_id)
+
+async def reconcile_invoices():
+    """Один проход: статусы всех неоплаченных счетов пачками через getInvoices"""
+    invoice_ids = await db.get_pending_invoice_ids()
+    for i in range(0, len(invoice_ids), INVOICE_BATCH_SIZE):
+        batch = invoice_ids[i:i + INVOICE_BATCH_SIZE]
+        data = await cryptopay.get_invoices(batch)
+        if not data.get("ok") or not isinstance(data.get("result"), dict):
+            continue
+        for item in data["result"].get("items") or []:
+            status = item.get("status")
+            invoice_id = int(item["invoice_id"])
+            if status == "paid":
+                amount = float(item.get("amount", 0))
+                invoice = await db.mark_invoice_paid(
+                    invoice_id, amount,
+                    build_messages=lambda user_id, lang: deposit_messages(user_id, lang, invoice_id, amount),
+                )
+                if invoice is not None:
+                    logger.info(f"Invoice {invoice_id} paid: {invoice.amount} TON to user {invoice.user_id}")
+                    outbox_worker.wake()
+            elif status == "expired":
+                await db.set_invoice_status(invoice_id, "expired")
+    return len(invoice_ids)
+
+DEPOSIT_STICKER = "CAACAgIAAxkBAAEOvPloVUPLwmRLS0gSrDAzbXBqSoqZRgAC9wADVp29CgtyJB1I9A0wNgQ"
+WITHDRAW_STICKER = "CAACAgIAAxkBAAEOthVoUFVeKz06CYbsn5GfPido8X8ftAACAQEAAladvQoivp8OuMLmNDYE"
+
+def deposit_messages(user_id: int, lang: Optional[str], invoice_id: int, amount: float) -> list:
+    lang = lang or "ru"
+    return [
+        sticker_message(user_id, DEPOSIT_STICKER, "deposit", invoice_id),
+        text_message(user_id, t("check_payment_paid", lang, amount=amount), "deposit", invoice_id,
+                     reply_markup=keyboard("back_to_main", lang), final=True),
+    ]
+
+def withdraw_messages(user_id: int, lang: Optional[str], amount: float) -> list:
+    lang = lang or "ru"
+    return [
+        sticker_message(user_id, WITHDRAW_STICKER, "withdraw"),
+        text_message(user_id, t("withdraw_success", lang, amount=amount), "withdraw",
+                     reply_markup=keyboard("back_to_main", lang), final=True),
+    ]
+
+async def invoice_reconciler():
+    """Фоновая сверка неоплаченных счетов; без счетов — ждёт нового счёта"""
+    while True:
+        invoice_created.clear()
+        try:
+            pending = await reconcile_invoices()
+        except Exception as e:
+            logger.error(f"Invoice reconciliation failed: {e}")
+            pending = 1
+        if pending:
+            await asyncio.sleep(INVOICE_POLL_INTERVAL)
+        else:
+            try:
+                await asyncio.wait_for(invoice_created.wait(), timeout=60)
+            except asyncio.TimeoutError:
+                pass
+
+# Режим работы: polling (по умолчанию) или webhook
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower()
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # публичный адрес, например https://bot.example.com/webhook
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")  # обязателен в webhook-режиме
+WEBAPP_HOST = os.getenv("WEBAPP_HOST", "0.0.0.0")
+WEBAPP_PORT = int(os.getenv("WEBAPP_PORT", "8080"))
+
+async def start_services():
+    """БД, CryptoPay, метрики и фоновые задачи — общие для polling и webhook"""
     await db.init()
+    await cryptopay.start()
+    # Имя бота для реферальных ссылок — один раз при запуске, дальше раз в BOT_IDENTITY_REFRESH секунд
+    await bot_identity.refresh()
+    spawn(bot_identity.refresh_periodically(float(os.getenv("BOT_IDENTITY_REFRESH", "3600"))))
+    metrics_runner = None
+    if os.getenv("METRICS_PORT"):
+        metrics_runner = await start_metrics_server(
+            os.getenv("METRICS_HOST", "127.0.0.1"), int(os.getenv("METRICS_PORT"))
+        )
     
     # Устанавливаем команды бота
     await set_bot_commands()
     
-    # Запускаем планировщик автоматической рассылки
-    asyncio.create_task(weekly_winner_scheduler())
-    
-    # --- ДОБАВЛЯЕМ ФОНОВУЮ ЗАДАЧУ ДЛЯ ТИРАЖЕЙ ---
-    asyncio.create_task(draw_scheduler())
-    
-    await dp.start_polling(bot)
+    # Планировщики работают только в реплике-лидере
+    spawn(leader.run())
+    return metrics_runner
+
+async def leader_jobs():
+    """Фоновые задачи, которые должны идти ровно в одной реплике"""
+    draw_registry.create = True
+    try:
+        # Продолжаем рассылки, прерванные перезапуском
+        await resume_broadcasts()
+        tasks = [asyncio.create_task(job) for job in (
+            # Планировщик автоматической рассылки
+            weekly_winner_scheduler(),
+            # Сверка счетов на пополнение
+            invoice_reconciler(),
+            # Тиражи
+            draw_scheduler(),
+            # Уведомления из outbox
+            outbox_worker.run(),
+        )]
+        try:
+            # Задачи живут и умирают вместе: упавшая останавливает остальные,
+            # LeaderElector перезапустит всю группу
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+            for task in done:
+                if not task.cancelled() and task.exception() is not None:
+                    raise task.exception()
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+    finally:
+        draw_registry.create = False
+
+# Аренда лидера: резервная реплика забирает задачи через LEADER_LEASE_TTL после падения лидера
+leader = LeaderElector(
+    db, "scheduler", leader_jobs,
+    ttl=float(os.getenv("LEADER_LEASE_TTL", "15")),
+    renew_interval=float(os.getenv("LEADER_RENEW_INTERVAL", "5")),
+)
+
+async def stop_services(metrics_runner=None):
+    for task in list(background_tasks):
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    await cryptopay.close()
+    if metrics_runner is not None:
+        await metrics_runner.cleanup()
+    await db.engine.dispose()
+
+async def run_webhook():
+    """Приём апдейтов через вебхук до SIGINT/SIGTERM.
+
+    Локальная проверка: BOT_MODE=webhook без WEBHOOK_URL (вебхук в Telegram не ставится),
+    затем curl -X POST -H "X-Telegram-Bot-Api-Secret-Token: $WEBHOOK_SECRET"
+    -H "Content-Type: application/json" -d @update.json http://127.0.0.1:8080/webhook
+    """
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            pass
+    await dp.emit_startup(bot=bot)
+    runner = await start_webhook_server(dp, bot, WEBAPP_HOST, WEBAPP_PORT, WEBHOOK_PATH, secret_token=WEBHOOK_SECRET)
+    try:
+        if WEBHOOK_URL:
+            await bot.set_webhook(
+                WEBHOOK_URL,
+                secret_token=WEBHOOK_SECRET,
+                allowed_updates=dp.resolve_used_update_types(),
+            )
+        await stop.wait()
+    finally:
+        # Новые апдейты не принимаются, текущие дорабатывают (см. SecretTokenRequestHandler.close)
+        await runner.cleanup()
+        await dp.emit_shutdown(bot=bot)
+
+# Запуск бота
+async def main():
+    if BOT_MODE == "webhook":
+        # Проверяем до запуска сервисов: без секрета вебхук не поднимаем
+        check_secret_token(WEBHOOK_SECRET)
+    metrics_runner = await start_services()
+    try:
+        if BOT_MODE == "webhook":
+            await run_webhook()
+        else:
+            # Вебхук, оставшийся от webhook-режима, мешает getUpdates
+            await bot.delete_webhook()
+            await dp.start_polling(bot, close_bot_session=False)
+    finally:
+        await stop_services(metrics_runner)
+        await bot.session.close()
 
 async def set_bot_commands():
     """Установка команд бота"""
@@ -1201,33 +1507,9 @@ async def send_weekly_winner_broadcast():
         # Генерируем случайный ID победителя
         fake_id = str(random.randint(100000000, 999999999))
         winner_id_masked = fake_id[:-3] + "***"
-        
-        # Получаем всех пользователей
-        async with db.async_session() as session:
-            from sqlalchemy import select
-            result = await session.execute(select(User))
-            users = result.scalars().all()
-        
-        count = 0
-        for user in users:
-            lang = getattr(user, "lang", "ru")
-            try:
-                # Кнопка "Испытать удачу" для перехода в главное меню
-                builder = InlineKeyboardBuilder()
-                builder.row(InlineKeyboardButton(text=t("try_luck", lang), callback_data="back_to_main"))
-                
-                await bot.send_message(
-                    user.user_id,
-                    t("second_chance_winner", lang, winner_id=winner_id_masked),
-                    reply_markup=builder.as_markup()
-                )
-                count += 1
-            except Exception as e:
-                logger.error(f"Error sending weekly winner broadcast to user {user.user_id}: {e}")
-                continue
-        
-        logger.info(f"Weekly winner broadcast sent to {count} users")
-        
+        # Имя по дате: повторный запуск в тот же день продолжит, а не повторит рассылку
+        name = f"weekly_{datetime.now(timezone.utc):%Y-%m-%d}"
+        await run_broadcast(name, "second_chance", {"winner_id": winner_id_masked}, report_chat_id=ADMIN_ID)
     except Exception as e:
         logger.error(f"Error in weekly winner broadcast: {e}")
 
@@ -1243,21 +1525,7 @@ async def help_command(message: types.Message):
 @dp.message(Command("balance"))
 async def balance_command(message: types.Message):
     user = await db.get_user(message.from_user.id)
-    history = db.get_history(user)
-    history_text = t("history", user.lang)
-    if history:
-        for h in history[-5:]:  # Показываем последние 5 операций
-            if h.get("type") == "deposit":
-                desc = t("history_deposit", user.lang, amount=h.get("amount"))
-            elif h.get("type") == "withdraw":
-                desc = t("history_withdraw", user.lang, amount=h.get("amount"))
-            elif h.get("type") == "lottery":
-                desc = t("history_lottery", user.lang, tickets=h.get("tickets", 0), win=h.get("win", 0))
-            else:
-                desc = h.get("desc", "")
-            history_text += f"• {desc}\n"
-    else:
-        history_text += t("no_history", user.lang)
+    history_text = await build_history_text(user, limit=5)
     
     await message.answer(
         t("balance_text", user.lang, balance=user.balance) + history_text,
@@ -1270,18 +1538,14 @@ async def deposit_command(message: types.Message, state: FSMContext):
     await state.set_state(UserStates.waiting_for_deposit_amount)
     await message.answer(
         t("deposit_menu", user.lang),
-        reply_markup=InlineKeyboardMarkup(inline_keyboard=[[
-            InlineKeyboardButton(text=t("back", user.lang), callback_data="back_to_main")
-        ]])
+        reply_markup=keyboard("back_to_main", user.lang)
     )
 
 @dp.message(Command("withdraw"))
 async def withdraw_command(message: types.Message, state: FSMContext):
     user = await db.get_user(message.from_user.id)
     await state.set_state(UserStates.waiting_for_withdraw_amount)
-    menu_markup = InlineKeyboardMarkup(inline_keyboard=[[
-        InlineKeyboardButton(text=t("back", user.lang), callback_data="back_to_main")
-    ]])
+    menu_markup = keyboard("back_to_main", user.lang)
     if user.balance < 1:
         await message.answer(t("withdraw_min", user.lang), reply_markup=menu_markup)
         await state.clear()
@@ -1295,111 +1559,59 @@ async def withdraw_command(message: types.Message, state: FSMContext):
 @dp.message(Command("play"))
 async def play_command(message: types.Message):
     user = await db.get_user(message.from_user.id)
-    builder = InlineKeyboardBuilder()
-    builder.add(InlineKeyboardButton(text=t("agree_button", user.lang), callback_data="agree_lottery"))
-    builder.add(InlineKeyboardButton(text=t("back", user.lang), callback_data="back_to_main"))
     await message.answer(
         t("agree_lottery", user.lang),
-        reply_markup=builder.as_markup()
+        reply_markup=keyboard("play", user.lang)
     )
 
 @dp.message(Command("rules"))
 async def rules_command(message: types.Message):
     user = await db.get_user(message.from_user.id)
     lang = user.lang
-    builder = InlineKeyboardBuilder()
-    builder.row(InlineKeyboardButton(text=t("next", lang), callback_data="rules_next"))
-    builder.row(InlineKeyboardButton(text=t("back", lang), callback_data="back_to_main"))
     await message.answer(
         t("rules_page1", lang),
-        reply_markup=builder.as_markup(),
+        reply_markup=keyboard("rules_page1", lang),
         disable_web_page_preview=True
     )
 
 @dp.message(Command("referral"))
 async def referral_command(message: types.Message):
-    user_id = message.from_user.id
-    user = await db.get_user(user_id)
-    referrals = db.get_referrals(user)
-    total_referrals = len(referrals)
-    active_referrals = []
-    for rid in referrals:
-        ref_user = await db.get_user(rid)
-        if getattr(ref_user, "ref_purchases", 0) > 0:
-            active_referrals.append(rid)
-    total_active = len(active_referrals)
-    earned = round(getattr(user, "earned", 0.0), 2)
-    last_active = active_referrals[-3:]
-    total_purchases = 0
-    for rid in referrals:
-        ref_user = await db.get_user(rid)
-        total_purchases += getattr(ref_user, "ref_purchases", 0)
+    user = await db.get_user(message.from_user.id)
     lang = user.lang
-    ref_link = f"https://t.me/{(await bot.get_me()).username}?start=ref_{user_id}"
-    ref_percent = int(get_ref_percent(total_referrals) * 100)
-    next_level, next_percent = get_next_ref_level(total_referrals)
-    max_percent = 25
-    # Таблица уровней
-    ref_table = (
-        "<b>Уровни реферальной программы:</b>\n"
-        "1-2 приглашённых — 10%\n"
-        "3-4 — 12%\n"
-        "5-9 — 15%\n"
-        "10-19 — 18%\n"
-        "20-29 — 20%\n"
-        "30-49 — 22%\n"
-        "50+ — 25%\n"
-        if lang == 'ru' else
-        "<b>Referral program levels:</b>\n"
-        "1-2 invited — 10%\n"
-        "3-4 — 12%\n"
-        "5-9 — 15%\n"
-        "10-19 — 18%\n"
-        "20-29 — 20%\n"
-        "30-49 — 22%\n"
-        "50+ — 25%\n"
-    )
-    # Прогресс-бар
-    bar_total = next_level if next_level else total_referrals
-    bar_filled = min(total_referrals, bar_total)
-    bar_length = 10
-    filled = int(bar_length * bar_filled / bar_total) if bar_total else bar_length
-    empty = bar_length - filled
-    bar = "[" + "■" * filled + "□" * empty + "]"
-    if next_level:
-        progress_text = (
-            f"\n<b>Ваш бонус:</b> {ref_percent}%  <b>({total_referrals} приглашённых)</b>\n"
-            f"{bar} {total_referrals}/{next_level} до {int(next_percent*100)}%\n"
-            f"Максимальный бонус: {max_percent}%"
-        ) if lang == 'ru' else (
-            f"\n<b>Your bonus:</b> {ref_percent}%  <b>({total_referrals} invited)</b>\n"
-            f"{bar} {total_referrals}/{next_level} to {int(next_percent*100)}%\n"
-            f"Maximum bonus: {max_percent}%"
-        )
-    else:
-        progress_text = (
-            f"\n<b>Ваш бонус:</b> {ref_percent}%  <b>({total_referrals} приглашённых)</b>\n"
-            f"{bar} {total_referrals}/{total_referrals}\n"
-            f"Вы достигли максимального бонуса!"
-        ) if lang == 'ru' else (
-            f"\n<b>Your bonus:</b> {ref_percent}%  <b>({total_referrals} invited)</b>\n"
-            f"{bar} {total_referrals}/{total_referrals}\n"
-            f"You have reached the maximum bonus!"
-        )
-    text = t("referral_menu", lang, ref_link=ref_link, total_referrals=total_referrals, total_active=total_active, earned=earned, total_purchases=total_purchases)
-    text += ref_table + progress_text
-    if last_active:
-        text += "\n" + t("referral_last_active", lang)
-        for rid in last_active:
-            text += f"- {rid}\n"
-    text += t("referral_bonus_info", lang, percent=ref_percent)
+    text = await build_referral_text(user)
     await message.answer(
         text,
-        reply_markup=InlineKeyboardMarkup(inline_keyboard=[[ 
-            InlineKeyboardButton(text=t("back", lang), callback_data="back_to_main")
-        ]])
+        reply_markup=keyboard("back_to_main", lang)
     )
 
+@dp.message(Command("cachestats"))
+async def cachestats_command(message: types.Message):
+    """Статистика кэша пользователей (только для админа)"""
+    if message.from_user.id != ADMIN_ID:
+        return
+    stats = db.cache_stats()
+    await message.answer("\n".join(f"{k}: {v}" for k, v in stats.items()))
+
+@dp.message(Command("dbstats"))
+async def dbstats_command(message: types.Message, command: CommandObject):
+    """Top-N SQL-запросов по суммарному времени (только для админа): /dbstats [N] или /dbstats reset"""
+    if message.from_user.id != ADMIN_ID:
+        return
+    if query_profiler is None:
+        await message.answer("Профилирование выключено (DB_PROFILE=1)")
+        return
+    arg = (command.args or "").strip()
+    if arg == "reset":
+        query_profiler.reset()
+        await message.answer("Статистика запросов сброшена")
+        return
+    n = int(arg) if arg.isdigit() else 10
+    report = query_profiler.report(n)
+    # Лимит Telegram — 4096 символов
+    if len(report) > 4000:
+        report = report[:4000] + "\n..."
+    await message.answer(f"<pre>{html.escape(report)}</pre>")
+
 # Прогрессивная реферальная система
 REF_LEVELS = [
     (1, 2, 0.10),
@@ -1423,63 +1635,90 @@ def get_next_ref_level(ref_count):
             return min_n, percent
     return None, None
 
-# --- ДОБАВЛЯЕМ ФОНОВУЮ ЗАДАЧУ ДЛЯ ТИРАЖЕЙ ---
+# --- ЖИЗНЕННЫЙ ЦИКЛ ТИРАЖЕЙ ---
+DRAW_DURATION_MINUTES = 1
+# Текущий тираж в памяти: покупки не обращаются к таблице draws за поиском тиража
+# Новые тиражи открывает только лидер (см. leader_jobs)
+draw_registry = DrawRegistry(db, duration_minutes=DRAW_DURATION_MINUTES, create=False)
+
 async def draw_scheduler():
-    print("[DEBUG] draw_scheduler started")
+    """Тиражи по таймерам: закрытие ровно в end_time, следующий тираж открывается сразу"""
+    logger.info("draw_scheduler started")
+    # После простоя: все просроченные тиражи одним запросом
+    for overdue in await db.get_finished_draws():
+        logger.info(f"Recovering overdue draw {overdue.code}")
+        spawn(finish_and_notify_draw(overdue))
+    draw = await draw_registry.get()
+    logger.info(f"Current draw {draw.code} until {draw.end_time}")
     while True:
-        # Завершаем все завершённые тиражи
-        finished_draws = await db.get_finished_draws()
-        for draw in finished_draws:
-            print(f"[DEBUG] finishing expired draw: {draw.code}")
-            await finish_and_notify_draw(draw)
-        # Проверяем, есть ли активный тираж
-        draw = await db.get_active_draw()
-        now = datetime.utcnow()
-        print(f"[DEBUG] draw: {draw}, now: {now}")
-        if not draw:
-            print(f"[DEBUG] draw is None or ended. draw={draw}")
-            new_draw = await db.create_new_draw(duration_minutes=1)
-            print(f"[DEBUG] new draw created: {new_draw.code}")
-        await asyncio.sleep(2)
-
-async def finish_and_notify_draw(draw):
-    print(f"[DEBUG] finish_and_notify_draw for draw {draw.code}")
-    entries = await db.get_draw_entries(draw.id)
-    print(f"[DEBUG] entries: {entries}")
-    if not entries:
-        await db.finish_draw(draw)
-        print(f"[DEBUG] draw {draw.code} finished (no entries)")
-        return
-    notified = set()
-    for entry in entries:
-        user = await db.get_user(entry.user_id)
-        total_win = 0
-        for _ in range(entry.tickets):
-            win_percent = random.uniform(0.1, 0.5)
-            win_amount = round(1.0 * win_percent, 2)
-            total_win += win_amount
-        if total_win > 0:
-            user.balance += total_win
-            history = db.get_history(user)
-            history.append({"type": "win", "amount": total_win, "draw_code": draw.code})
-            db.set_history(user, history)
-            await db.update_user(user)
+        delay = (draw.end_time - datetime.utcnow()).total_seconds()
+        if delay > 0:
+            await asyncio.sleep(delay)
         try:
-            # Сначала отправляем стикер (утёнок)
-            await bot.send_sticker(entry.user_id, "CAACAgIAAxkBAAEOvPloVUPLwmRLS0gSrDAzbXBqSoqZRgAC9wADVp29CgtyJB1I9A0wNgQ")
-            # Затем сообщение о выигрыше с локализацией
-            lang = getattr(user, 'lang', 'ru')
-            await bot.send_message(
-                entry.user_id,
-                WIN_MSG[lang].format(code=draw.code, amount=total_win)
-            )
-            print(f"[DEBUG] sent result to user {entry.user_id}")
-            notified.add(entry.user_id)
+            next_draw = await draw_registry.rollover(draw)
         except Exception as e:
-            print(f"[DEBUG] error sending to user {entry.user_id}: {e}")
+            logger.error(f"Failed to open next draw: {e}")
+            await asyncio.sleep(1)
             continue
-    await db.finish_draw(draw)
-    print(f"[DEBUG] draw {draw.code} finished (notified)")
+        logger.info(f"New draw {next_draw.code} until {next_draw.end_time}")
+        # Расчёт закрытого тиража идёт в фоне и не задерживает следующий
+        spawn(finish_and_notify_draw(draw))
+        draw = next_draw
+
+# Последние расчёты тиражей: код, участники, сумма выплат, время расчёта, доставка уведомлений
+settlement_stats = deque(maxlen=100)
+settlement_duration = REGISTRY.register(Histogram(
+    "bot_draw_settlement_seconds", "Draw settlement time"))
+
+draw_notifications = REGISTRY.register(Counter(
+    "bot_draw_notifications_total", "Draw result notifications by status", ["status"]))
+WIN_STICKER = "CAACAgIAAxkBAAEOvPloVUPLwmRLS0gSrDAzbXBqSoqZRgAC9wADVp29CgtyJB1I9A0wNgQ"
+
+def record_draw_notification(code: str, status: str):
+    """Итог отправки сообщения о тираже (стикер или текст) — в запись settlement_stats"""
+    draw_notifications.inc(1, status=status)
+    # Свежие тиражи в конце очереди
+    record = next((r for r in reversed(settlement_stats) if r["code"] == code), None)
+    if record is None:
+        return
+    record[status] = record.get(status, 0) + 1
+    record["notify_seconds"] = time.monotonic() - record["settled_at"]
+
+def draw_result_messages(code: str, winnings: dict, langs: dict) -> list:
+    """Стикер (утёнок) и сообщение о выигрыше каждому участнику"""
+    messages = []
+    for user_id, amount in winnings.items():
+        lang = langs.get(user_id) or 'ru'
+        messages.append(sticker_message(user_id, WIN_STICKER, "draw_result", code))
+        messages.append(text_message(user_id, WIN_MSG[lang].format(code=code, amount=amount), "draw_result", code))
+    return messages
+
+async def finish_and_notify_draw(draw):
+    """Закрывает и рассчитывает тираж; уведомления пишутся в outbox в той же транзакции"""
+    started = time.perf_counter()
+    settled = await db.settle_draw(
+        draw, compute_prizes,
+        build_messages=lambda winnings, langs: draw_result_messages(draw.code, winnings, langs),
+    )
+    if settled is None:
+        logger.info("draw already finished code=%s", draw.code)
+        return
+    winnings, langs = settled
+    elapsed = time.perf_counter() - started
+    record = {
+        "code": draw.code,
+        "participants": len(winnings),
+        "payout": round(sum(winnings.values()), 2),
+        "seconds": elapsed,
+        "settled_at": time.monotonic(),
+        "delivered": 0,
+        "blocked": 0,
+        "failed": 0,
+    }
+    settlement_stats.append(record)
+    settlement_duration.observe(elapsed)
+    logger.info("draw settled code=%s participants=%s seconds=%.3f", draw.code, len(winnings), elapsed)
+    outbox_worker.wake()
 
 # Добавляю локализацию для сообщения о выигрыше
 WIN_MSG = {
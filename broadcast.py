@@ -0,0 +1,183 @@
+"""Рассылки с ограничением скорости Telegram"""
+import asyncio
+import logging
+import time
+from dataclasses import dataclass, field
+from aiogram.exceptions import (
+    TelegramRetryAfter,
+    TelegramForbiddenError,
+    TelegramNetworkError,
+    TelegramServerError,
+    TelegramAPIError,
+)
+
+logger = logging.getLogger(__name__)
+
+DELIVERED = "delivered"
+BLOCKED = "blocked"
+FAILED = "failed"
+
+class TokenBucket:
+    """Глобальный ограничитель: rate сообщений в секунду, всплеск до capacity"""
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def pause(self, seconds: float):
+        """Останавливает всех отправителей (ответ 429 с retry_after)"""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0
+
+@dataclass
+class BroadcastStats:
+    delivered: int = 0
+    blocked: int = 0
+    failed: int = 0
+    started_at: float = field(default_factory=time.monotonic)
+    finished_at: float = None
+
+    @property
+    def processed(self) -> int:
+        return self.delivered + self.blocked + self.failed
+
+    @property
+    def elapsed(self) -> float:
+        return (self.finished_at or time.monotonic()) - self.started_at
+
+    def record(self, status: str):
+        if status == DELIVERED:
+            self.delivered += 1
+        elif status == BLOCKED:
+            self.blocked += 1
+        else:
+            self.failed += 1
+
+    def report(self) -> str:
+        return (
+            f"Доставлено: {self.delivered}\n"
+            f"Заблокировали бота: {self.blocked}\n"
+            f"Ошибки: {self.failed}\n"
+            f"Время: {self.elapsed:.0f} с"
+        )
+
+class Broadcaster:
+    """Отправка сообщений через общий лимит скорости и ограниченный параллелизм"""
+
+    def __init__(self, bot, rate: float = 25, concurrency: int = 20, max_retries: int = 3):
+        self.bot = bot
+        self.bucket = TokenBucket(rate)
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+
+    async def deliver(self, method, chat_id: int, **kwargs) -> str:
+        """Вызывает метод бота (send_message, send_sticker...) с учётом лимитов и RetryAfter"""
+        for attempt in range(self.max_retries + 1):
+            await self.bucket.acquire()
+            try:
+                await method(chat_id, **kwargs)
+                return DELIVERED
+            except TelegramRetryAfter as e:
+                logger.warning(f"Flood control, pausing for {e.retry_after}s")
+                self.bucket.pause(e.retry_after)
+            except TelegramForbiddenError:
+                return BLOCKED
+            except (TelegramNetworkError, TelegramServerError) as e:
+                logger.warning(f"Temporary error sending to {chat_id}: {e}")
+                await asyncio.sleep(2 ** attempt)
+            except TelegramAPIError as e:
+                logger.info(f"Failed to send to {chat_id}: {e}")
+                return FAILED
+        return FAILED
+
+    async def run(self, recipients, build, stats: BroadcastStats = None, checkpoint=None,
+                  on_progress=None, chunk_size: int = 500, progress_interval: float = 5.0) -> BroadcastStats:
+        """Рассылка по recipients — асинхронному итератору (user_id, lang), отсортированному по user_id.
+
+        build(lang) возвращает (text, reply_markup). После каждой пачки вызывается
+        checkpoint(last_user_id, stats), чтобы прерванную рассылку можно было продолжить.
+        on_progress(stats) вызывается раз в progress_interval секунд.
+        """
+        stats = stats or BroadcastStats()
+        reporter = None
+        if on_progress is not None:
+            reporter = asyncio.create_task(self._report(stats, on_progress, progress_interval))
+        try:
+            chunk = []
+            async for user_id, lang in recipients:
+                chunk.append((user_id, lang))
+                if len(chunk) >= chunk_size:
+                    await self._send_chunk(chunk, build, stats, checkpoint)
+                    chunk = []
+            if chunk:
+                await self._send_chunk(chunk, build, stats, checkpoint)
+        finally:
+            stats.finished_at = time.monotonic()
+            if reporter is not None:
+                reporter.cancel()
+        return stats
+
+    async def fan_out(self, recipients, send_one, stats: BroadcastStats = None,
+                      chunk_size: int = 500) -> BroadcastStats:
+        """Вызывает send_one(recipient) -> статус для каждого получателя, не больше concurrency сразу.
+
+        send_one отправляет через deliver(), поэтому соблюдает общий лимит и RetryAfter.
+        """
+        stats = stats or BroadcastStats()
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def run_one(recipient):
+            async with semaphore:
+                try:
+                    stats.record(await send_one(recipient))
+                except Exception as e:
+                    logger.warning(f"Delivery to {recipient} failed: {e}")
+                    stats.record(FAILED)
+
+        recipients = list(recipients)
+        try:
+            # Пачками, чтобы не держать корутины на всех получателей сразу
+            for start in range(0, len(recipients), chunk_size):
+                await asyncio.gather(*(run_one(r) for r in recipients[start:start + chunk_size]))
+        finally:
+            stats.finished_at = time.monotonic()
+        return stats
+
+    async def _send_chunk(self, chunk, build, stats: BroadcastStats, checkpoint):
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def send_one(user_id, lang):
+            async with semaphore:
+                text, reply_markup = build(lang)
+                stats.record(await self.deliver(self.bot.send_message, user_id, text=text, reply_markup=reply_markup))
+
+        await asyncio.gather(*(send_one(user_id, lang) for user_id, lang in chunk))
+        if checkpoint is not None:
+            await checkpoint(chunk[-1][0], stats)
+
+    @staticmethod
+    async def _report(stats: BroadcastStats, on_progress, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await on_progress(stats)
+            except Exception as e:
+                logger.warning(f"Broadcast progress callback failed: {e}")
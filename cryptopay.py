@@ -1,16 +1,86 @@
 import aiohttp
 from uuid import uuid4
-from typing import Optional, Dict
+from typing import Optional, Dict, List
 import logging
+import time
 import traceback
 
 logger = logging.getLogger(__name__)
 
 class CryptoPay:
-    def __init__(self, token: str):
+    def __init__(
+        self,
+        token: str,
+        limit: int = 100,
+        limit_per_host: int = 20,
+        keepalive_timeout: float = 30,
+        ttl_dns_cache: int = 300
+    ):
         self.token = token
         self.base_url = "https://pay.crypt.bot/api"
         self.headers = {"Crypto-Pay-API-Token": self.token}
+        # Параметры пула соединений общей сессии
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.ttl_dns_cache = ttl_dns_cache
+        self._session: Optional[aiohttp.ClientSession] = None
+        # Задержки по методам API: count, errors, total, max (секунды)
+        self.metrics: Dict[str, Dict] = {}
+
+    async def start(self):
+        """Создаёт общую сессию с keep-alive (вызывается при старте бота)"""
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.limit,
+                limit_per_host=self.limit_per_host,
+                keepalive_timeout=self.keepalive_timeout,
+                ttl_dns_cache=self.ttl_dns_cache,
+            )
+            self._session = aiohttp.ClientSession(connector=connector, headers=self.headers)
+
+    async def close(self):
+        """Закрывает сессию и соединения пула (вызывается при остановке бота)"""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    async def _request(self, http_method: str, endpoint: str, timeout: float, **kwargs) -> Dict:
+        if self._session is None or self._session.closed:
+            await self.start()
+        started = time.perf_counter()
+        failed = True
+        try:
+            async with self._session.request(
+                http_method,
+                f"{self.base_url}/{endpoint}",
+                timeout=aiohttp.ClientTimeout(total=timeout),
+                **kwargs
+            ) as response:
+                data = await response.json()
+                failed = False
+                return data
+        finally:
+            self._record(endpoint, time.perf_counter() - started, failed)
+
+    def _record(self, endpoint: str, elapsed: float, failed: bool):
+        stats = self.metrics.setdefault(endpoint, {"count": 0, "errors": 0, "total": 0.0, "max": 0.0})
+        stats["count"] += 1
+        stats["errors"] += int(failed)
+        stats["total"] += elapsed
+        stats["max"] = max(stats["max"], elapsed)
+
+    def latency_stats(self) -> Dict[str, Dict]:
+        """Средняя и максимальная задержка по каждому методу API, мс"""
+        return {
+            endpoint: {
+                "count": stats["count"],
+                "errors": stats["errors"],
+                "avg_ms": round(stats["total"] / stats["count"] * 1000, 1) if stats["count"] else 0.0,
+                "max_ms": round(stats["max"] * 1000, 1),
+            }
+            for endpoint, stats in self.metrics.items()
+        }
 
     async def create_invoice(
         self,
@@ -29,16 +99,9 @@ class CryptoPay:
             "expires_in": expires_in
         }
         try:
-            timeout = aiohttp.ClientTimeout(total=10)
-            async with aiohttp.ClientSession(timeout=timeout) as session:
-                async with session.post(
-                    f"{self.base_url}/createInvoice",
-                    data=params,
-                    headers=self.headers
-                ) as response:
-                    data = await response.json()
-                    logger.info(f"create_invoice response: {data}")
-                    return data
+            data = await self._request("POST", "createInvoice", timeout=10, data=params)
+            logger.info(f"create_invoice response: {data}")
+            return data
         except Exception as e:
             logger.error(f"create_invoice error: {e}\n{traceback.format_exc()}")
             return {"ok": False, "error": repr(e)}
@@ -58,36 +121,24 @@ class CryptoPay:
             "spend_id": str(uuid4()),
         }
         try:
-            timeout = aiohttp.ClientTimeout(total=10)
-            async with aiohttp.ClientSession(timeout=timeout) as session:
-                async with session.get(
-                    f"{self.base_url}/transfer",
-                    params=params,
-                    headers=self.headers
-                ) as response:
-                    data = await response.json()
-                    logger.info(f"transfer response: {data}")
-                    return data
+            data = await self._request("GET", "transfer", timeout=10, params=params)
+            logger.info(f"transfer response: {data}")
+            return data
         except Exception as e:
             logger.error(f"transfer error: {e}\n{traceback.format_exc()}")
             return {"ok": False, "error": repr(e)}
 
-    async def check_invoice(self, invoice_id: str) -> Dict:
-        """Проверка статуса инвойса"""
-        params = {"invoice_ids": invoice_id}
+    async def get_invoices(self, invoice_ids: List[int]) -> Dict:
+        """Статусы нескольких инвойсов одним запросом (до 1000 id)"""
+        params = {
+            "invoice_ids": ",".join(str(i) for i in invoice_ids),
+            "count": len(invoice_ids),
+        }
         try:
-            timeout = aiohttp.ClientTimeout(total=5)
-            async with aiohttp.ClientSession(timeout=timeout) as session:
-                async with session.get(
-                    f"{self.base_url}/getInvoices",
-                    params=params,
-                    headers=self.headers
-                ) as response:
-                    data = await response.json()
-                    logger.info(f"check_invoice response: {data}")
-                    if not data.get("ok") or not isinstance(data.get("result"), dict) or not data["result"].get("items"):
-                        return {"ok": False, "error": "Invoice not found"}
-                    return data
+            data = await self._request("GET", "getInvoices", timeout=10, params=params)
+            if not data.get("ok"):
+                logger.warning(f"get_invoices error response: {data}")
+            return data
         except Exception as e:
-            logger.error(f"check_invoice error: {e}\n{traceback.format_exc()}")
-            return {"ok": False, "error": repr(e)}
\ No newline at end of file
+            logger.error(f"get_invoices error: {e}\n{traceback.format_exc()}")
+            return {"ok": False, "error": repr(e)}
@@ -1,26 +1,33 @@
 import asyncio
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
-from sqlalchemy.orm import sessionmaker, declarative_base
-from sqlalchemy import Column, Integer, Float, String, Text, update, BigInteger, Boolean, DateTime, ForeignKey
-from sqlalchemy.dialects.postgresql import JSONB
-from sqlalchemy import select
+from sqlalchemy.orm import sessionmaker, declarative_base, aliased
+from sqlalchemy import Column, Integer, Float, String, Text, update, BigInteger, Boolean, DateTime, ForeignKey, Index, UniqueConstraint
+from sqlalchemy.dialects.postgresql import JSONB, insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy import select, func, case, exists, or_
 import json
-from sqlalchemy import text
+from sqlalchemy import text, inspect, insert, bindparam, delete
+from sqlalchemy.exc import DBAPIError
+import logging
 import string
 import random
+import time
+from collections import OrderedDict
 from datetime import datetime, timedelta
 
 Base = declarative_base()
 
+logger = logging.getLogger(__name__)
+
 class User(Base):
     __tablename__ = 'users'
     user_id = Column(BigInteger, primary_key=True)
     balance = Column(Float, default=0)
-    referrals = Column(Text, default='[]')  # JSON-строка
+    referrals = Column(Text, default='[]')  # устарело: см. таблицу referrals
     earned = Column(Float, default=0)
     ref_purchases = Column(Integer, default=0)
-    history = Column(Text, default='[]')  # JSON-строка
-    invited_by = Column(BigInteger, nullable=True)  # user_id пригласившего
+    history = Column(Text, default='[]')  # устарело: история перенесена в ledger (см. migrate.py)
+    invited_by = Column(BigInteger, nullable=True, index=True)  # user_id пригласившего
     lang = Column(String, default='ru')  # язык пользователя (ru/en)
     last_sticker_id = Column(BigInteger, nullable=True)  # ID последнего стикера для удаления
 
@@ -31,6 +38,13 @@ class Draw(Base):
     start_time = Column(DateTime, default=datetime.utcnow)
     end_time = Column(DateTime)
     is_active = Column(Boolean, default=True)
+    __table_args__ = (
+        # get_active_draw (каждая покупка) и поиск истёкших тиражей планировщиком
+        Index('ix_draws_active_end', 'is_active', 'end_time'),
+        # Открытых тиражей единицы — частичный индекс не растёт вместе с историей
+        Index('ix_draws_open_end', 'end_time',
+              postgresql_where=text('is_active'), sqlite_where=text('is_active = 1')),
+    )
 
 class DrawEntry(Base):
     __tablename__ = 'draw_entries'
@@ -38,77 +52,674 @@ class DrawEntry(Base):
     draw_id = Column(Integer, ForeignKey('draws.id'))
     user_id = Column(BigInteger)
     tickets = Column(Integer, default=1)
+    __table_args__ = (
+        # Нужен для INSERT ... ON CONFLICT (draw_id, user_id) в purchase_tickets;
+        # он же обслуживает выборку участников по draw_id (префикс индекса)
+        Index('uq_draw_entries_draw_user', 'draw_id', 'user_id', unique=True),
+    )
+
+class DrawClosedError(Exception):
+    """Тираж закрыт, пока шла покупка — нужно взять следующий"""
+
+class BroadcastTakenOverError(Exception):
+    """Рассылку забрал другой процесс (пульс этого процесса устарел)"""
+
+class Invoice(Base):
+    """Счёт CryptoPay на пополнение"""
+    __tablename__ = 'invoices'
+    invoice_id = Column(BigInteger, primary_key=True)
+    user_id = Column(BigInteger, nullable=False, index=True)
+    amount = Column(Float, nullable=False)
+    status = Column(String(16), default='active', index=True)  # active/paid/expired
+    created_at = Column(DateTime, default=datetime.utcnow)
+    paid_at = Column(DateTime, nullable=True)
+
+class Broadcast(Base):
+    """Состояние рассылки: позволяет продолжить прерванную рассылку"""
+    __tablename__ = 'broadcasts'
+    name = Column(String(64), primary_key=True)
+    kind = Column(String(32), nullable=False)
+    params = Column(Text, default='{}')  # JSON-строка с параметрами текста
+    last_user_id = Column(BigInteger, nullable=True)  # последний обработанный user_id
+    delivered = Column(Integer, default=0)
+    blocked = Column(Integer, default=0)
+    failed = Column(Integer, default=0)
+    status = Column(String(16), default='running')  # running/done
+    holder = Column(String(128), nullable=True)  # процесс, который сейчас отправляет
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow)  # пульс владельца
+
+class Lease(Base):
+    """Аренда роли (например, лидера фоновых задач): держатель продлевает её до expires_at"""
+    __tablename__ = 'leases'
+    name = Column(String(64), primary_key=True)
+    holder = Column(String(128), nullable=False)
+    expires_at = Column(DateTime, nullable=False)
+
+class FsmRecord(Base):
+    """Состояние FSM пользователя (aiogram) с ограниченным сроком жизни"""
+    __tablename__ = 'fsm_states'
+    key = Column(String(128), primary_key=True)  # bot_id:chat_id:user_id:destiny
+    state = Column(String(128), nullable=True)
+    data = Column(Text, default='{}')  # JSON-строка
+    expires_at = Column(DateTime, nullable=False, index=True)
+
+class OutboxMessage(Base):
+    """Исходящее сообщение Telegram, записанное в одной транзакции с изменением баланса"""
+    __tablename__ = 'outbox'
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    chat_id = Column(BigInteger, nullable=False)
+    method = Column(String(16), nullable=False)  # message/sticker
+    payload = Column(Text, nullable=False)  # JSON: text/reply_markup или sticker
+    kind = Column(String(32), nullable=False)  # draw_result/deposit/withdraw
+    ref = Column(String(64), nullable=True)  # код тиража, id счёта
+    status = Column(String(16), default='pending')  # pending/failed/blocked
+    attempts = Column(Integer, default=0)
+    next_attempt_at = Column(DateTime, default=datetime.utcnow)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    __table_args__ = (
+        Index('ix_outbox_status_next', 'status', 'next_attempt_at'),
+        Index('ix_outbox_chat_id', 'chat_id', 'id'),
+    )
+
+def outbox_rows(messages) -> list:
+    """Строки для INSERT в outbox из словарей chat_id/method/payload/kind/ref"""
+    now = datetime.utcnow()
+    return [
+        {"chat_id": m["chat_id"], "method": m["method"], "payload": json.dumps(m["payload"], ensure_ascii=False),
+         "kind": m["kind"], "ref": None if m.get("ref") is None else str(m["ref"]), "status": "pending", "attempts": 0,
+         "next_attempt_at": now, "created_at": now}
+        for m in messages
+    ]
+
+class SchemaVersion(Base):
+    """Номер последней применённой миграции (одна строка id=1)"""
+    __tablename__ = 'schema_version'
+    id = Column(Integer, primary_key=True)
+    version = Column(Integer, nullable=False)
+    updated_at = Column(DateTime, default=datetime.utcnow)
+
+# Ключ pg_advisory_lock: реплики, стартующие одновременно, мигрируют по очереди
+MIGRATION_LOCK_KEY = 7311001
+
+class UserCache:
+    """Ограниченный LRU-кэш строк User с TTL (в памяти процесса)"""
+
+    def __init__(self, maxsize: int = 10000, ttl: float = 60.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._items = OrderedDict()  # user_id -> (expires_at, User)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, user_id: int):
+        item = self._items.get(user_id)
+        if item is None:
+            self.misses += 1
+            return None
+        expires_at, user = item
+        if expires_at < time.monotonic():
+            del self._items[user_id]
+            self.evictions += 1
+            self.misses += 1
+            return None
+        self._items.move_to_end(user_id)
+        self.hits += 1
+        return user
+
+    def put(self, user: User):
+        self._items[user.user_id] = (time.monotonic() + self.ttl, user)
+        self._items.move_to_end(user.user_id)
+        while len(self._items) > self.maxsize:
+            self._items.popitem(last=False)
+            self.evictions += 1
+
+    def peek(self, user_id: int):
+        """Возвращает закэшированного пользователя без учёта статистики и TTL"""
+        item = self._items.get(user_id)
+        return item[1] if item else None
+
+    def invalidate(self, user_id: int):
+        self._items.pop(user_id, None)
+
+    def clear(self):
+        self._items.clear()
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._items),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+class Referral(Base):
+    __tablename__ = 'referrals'
+    id = Column(Integer, primary_key=True)
+    referrer_id = Column(BigInteger, nullable=False)  # кто пригласил
+    referee_id = Column(BigInteger, nullable=False)  # кого пригласили
+    created_at = Column(DateTime, default=datetime.utcnow)
+    __table_args__ = (
+        # Уникальный индекс начинается с referrer_id — им же пользуется COUNT
+        UniqueConstraint('referrer_id', 'referee_id', name='uq_referrals_pair'),
+    )
+
+class LedgerEntry(Base):
+    """Запись журнала операций (append-only, заменяет User.history)"""
+    __tablename__ = 'ledger'
+    id = Column(Integer, primary_key=True)
+    user_id = Column(BigInteger, nullable=False)
+    type = Column(String(32), nullable=False)  # game/win/deposit/withdraw/referral_bonus/cashback
+    amount = Column(Float, default=0)
+    tickets = Column(Integer, nullable=True)
+    draw_code = Column(String(6), nullable=True)
+    ref_id = Column(BigInteger, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    __table_args__ = (
+        Index('ix_ledger_user_created', 'user_id', 'created_at'),
+    )
 
 class AsyncDatabase:
-    def __init__(self, dsn):
+    def __init__(self, dsn, user_cache_size: int = 0, user_cache_ttl: float = 60.0):
         self.engine = create_async_engine(dsn, echo=False, future=True)
         self.async_session = sessionmaker(self.engine, expire_on_commit=False, class_=AsyncSession)
+        # Кэш пользователей выключен, если размер = 0
+        self.user_cache = UserCache(user_cache_size, user_cache_ttl) if user_cache_size > 0 else None
+
+    # Миграции по порядку: версия схемы = число применённых шагов. Шаги
+    # идемпотентны — прерванная миграция продолжается с первого неотмеченного.
+    # Новые таблицы, столбцы и индексы — новый шаг в конце (для таблиц и
+    # индексов модели достаточно ещё раз указать _migrate_tables).
+    MIGRATIONS = (
+        ("tables and indexes", "_migrate_tables"),
+        ("users.last_sticker_id", "_migrate_last_sticker_id"),
+        ("history -> ledger", "migrate_history_to_ledger"),
+        ("referrals backfill", "backfill_referrals"),
+        ("broadcasts.holder", "_migrate_broadcast_holder"),
+    )
 
     async def init(self):
+        """Приводит схему к последней версии; если она актуальна — один SELECT"""
+        version = await self.schema_version()
+        if version < len(self.MIGRATIONS):
+            await self.migrate()
+        elif version > len(self.MIGRATIONS):
+            logger.warning("schema version=%s is newer than this code (%s)", version, len(self.MIGRATIONS))
+
+    async def schema_version(self) -> int:
+        """0 — таблицы schema_version ещё нет"""
+        try:
+            async with self.engine.connect() as conn:
+                result = await conn.execute(select(SchemaVersion.version).where(SchemaVersion.id == 1))
+                return result.scalar() or 0
+        except DBAPIError:
+            return 0
+
+    async def migrate(self) -> int:
+        """Применяет недостающие шаги MIGRATIONS; возвращает итоговую версию"""
+        postgres = self.engine.dialect.name == 'postgresql'
+        async with self.engine.connect() as lock_conn:
+            if postgres:
+                await lock_conn.execute(text("SELECT pg_advisory_lock(:key)"), {"key": MIGRATION_LOCK_KEY})
+                await lock_conn.commit()
+            try:
+                async with self.engine.begin() as conn:
+                    await conn.run_sync(SchemaVersion.__table__.create, checkfirst=True)
+                # Под блокировкой: другая реплика могла уже всё применить
+                version = await self.schema_version()
+                for number, (name, step) in enumerate(self.MIGRATIONS[version:], start=version + 1):
+                    started = time.perf_counter()
+                    await getattr(self, step)()
+                    await self._set_schema_version(number)
+                    logger.info("schema migrated version=%s step=%s seconds=%.2f",
+                                number, name, time.perf_counter() - started)
+                    version = number
+            finally:
+                if postgres:
+                    await lock_conn.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": MIGRATION_LOCK_KEY})
+                    await lock_conn.commit()
+        return version
+
+    async def _set_schema_version(self, version: int):
+        async with self.engine.begin() as conn:
+            await conn.execute(
+                self._insert(SchemaVersion)
+                .values(id=1, version=version, updated_at=datetime.utcnow())
+                .on_conflict_do_update(index_elements=['id'], set_={"version": version, "updated_at": datetime.utcnow()})
+            )
+
+    async def _migrate_tables(self):
         async with self.engine.begin() as conn:
             await conn.run_sync(Base.metadata.create_all)
-            # Проверяем, есть ли столбец last_sticker_id, если нет - добавляем
-            try:
-                await conn.execute(text("SELECT last_sticker_id FROM users LIMIT 1"))
-            except:
-                await conn.execute(text("ALTER TABLE users ADD COLUMN last_sticker_id BIGINT"))
-                await conn.commit()
+            # Дубликаты от старой покупки (SELECT, затем INSERT) не дали бы создать уникальный индекс
+            await conn.run_sync(self._merge_duplicate_entries)
+            # create_all не добавляет индексы в уже существующие таблицы
+            await conn.run_sync(self._create_missing_indexes)
+
+    async def _migrate_last_sticker_id(self):
+        await self._add_column("users", "last_sticker_id", "BIGINT")
+
+    async def _migrate_broadcast_holder(self):
+        await self._add_column("broadcasts", "holder", "VARCHAR(128)")
+
+    async def _add_column(self, table: str, column: str, ddl_type: str):
+        async with self.engine.begin() as conn:
+            columns = await conn.run_sync(
+                lambda sync_conn: {c["name"] for c in inspect(sync_conn).get_columns(table)}
+            )
+            if column not in columns:
+                await conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl_type}"))
+
+    @staticmethod
+    def _merge_duplicate_entries(sync_conn):
+        """Схлопывает повторяющиеся (draw_id, user_id): билеты суммируются в строку с меньшим id"""
+        inspector = inspect(sync_conn)
+        if any(index["name"] == 'uq_draw_entries_draw_user' for index in inspector.get_indexes('draw_entries')):
+            return
+        duplicates = (
+            "SELECT draw_id, user_id, MIN(id) AS keep_id FROM draw_entries "
+            "WHERE draw_id IS NOT NULL AND user_id IS NOT NULL "
+            "GROUP BY draw_id, user_id HAVING COUNT(*) > 1"
+        )
+        if sync_conn.execute(text(duplicates + " LIMIT 1")).first() is None:
+            return
+        merged = sync_conn.execute(text(
+            "UPDATE draw_entries SET tickets = ("
+            " SELECT SUM(COALESCE(d.tickets, 1)) FROM draw_entries d"
+            " WHERE d.draw_id = draw_entries.draw_id AND d.user_id = draw_entries.user_id"
+            f") WHERE id IN (SELECT keep_id FROM ({duplicates}) g)"
+        )).rowcount
+        deleted = sync_conn.execute(text(
+            "DELETE FROM draw_entries WHERE id IN ("
+            " SELECT d.id FROM draw_entries d"
+            f" JOIN ({duplicates}) g ON d.draw_id = g.draw_id AND d.user_id = g.user_id"
+            " WHERE d.id <> g.keep_id)"
+        )).rowcount
+        logger.warning("merged duplicate draw entries pairs=%s deleted=%s", merged, deleted)
+
+    @staticmethod
+    def _create_missing_indexes(sync_conn):
+        inspector = inspect(sync_conn)
+        for table in Base.metadata.sorted_tables:
+            existing = {c["name"] for c in inspector.get_columns(table.name)}
+            for index in table.indexes:
+                missing = [c.name for c in index.columns if c.name not in existing]
+                if missing:
+                    # Старая схема без нужных столбцов — индекс создать нельзя
+                    logger.warning(f"Skipping index {index.name}: {table.name} has no columns {missing}")
+                    continue
+                index.create(sync_conn, checkfirst=True)
+
+    async def explain_draw_queries(self) -> dict:
+        """Планы горячих запросов к draws и draw_entries: {имя: текст плана}"""
+        now = datetime.utcnow()
+        queries = {
+            "active_draw": select(Draw).where(Draw.is_active == True, Draw.end_time > now)
+                .order_by(Draw.end_time.desc()).limit(1),
+            "expired_draws": select(Draw).where(Draw.is_active == True, Draw.end_time <= now),
+            "draw_entries": select(DrawEntry).where(DrawEntry.draw_id == 1),
+            "user_entry": select(DrawEntry).where(DrawEntry.draw_id == 1, DrawEntry.user_id == 1),
+        }
+        dialect = self.engine.dialect
+        prefix = "EXPLAIN QUERY PLAN " if dialect.name == 'sqlite' else "EXPLAIN "
+        plans = {}
+        async with self.engine.connect() as conn:
+            for name, query in queries.items():
+                sql = str(query.compile(dialect=dialect, compile_kwargs={"literal_binds": True}))
+                rows = (await conn.exec_driver_sql(prefix + sql)).all()
+                plans[name] = "\n".join(str(row[-1]) for row in rows)
+        return plans
+
+    def _insert(self, model):
+        """INSERT с поддержкой ON CONFLICT для текущего диалекта"""
+        if self.engine.dialect.name == 'postgresql':
+            return pg_insert(model)
+        return sqlite_insert(model)
 
     async def get_user(self, user_id: int):
-        print(f"[DEBUG] Ищу пользователя с user_id={user_id}")
+        if self.user_cache is not None:
+            user = self.user_cache.get(user_id)
+            if user is not None:
+                return user
+        logger.debug("user lookup user_id=%s", user_id)
         async with self.async_session() as session:
             result = await session.execute(select(User).where(User.user_id == user_id))
             user = result.scalar_one_or_none()
             if user:
-                print(f"[DEBUG] Пользователь найден: {user_id}")
+                self._cache_user(user)
                 return user
             # Если пользователя нет — создаём
-            print(f"[DEBUG] Пользователь не найден, создаю: {user_id}")
             user = User(user_id=user_id)
             session.add(user)
             await session.commit()
-            print(f"[DEBUG] Пользователь создан и добавлен в БД: {user_id}")
+            logger.info("user created user_id=%s", user_id)
+            self._cache_user(user)
             return user
 
-    async def update_user(self, user: User):
+    async def change_balance(self, user_id: int, delta: float, ledger_type: str = None,
+                             require_funds: bool = False):
+        """Атомарно меняет баланс на delta условным UPDATE (без чтения строки).
+
+        require_funds — списание только если хватает средств. ledger_type —
+        запись в журнал с суммой abs(delta) в той же транзакции.
+        Возвращает новый баланс или None (нет пользователя или не хватает средств).
+        """
+        stmt = update(User).where(User.user_id == user_id)
+        if require_funds:
+            stmt = stmt.where(User.balance >= -delta)
+        async with self.async_session() as session:
+            async with session.begin():
+                new_balance = (await session.execute(
+                    stmt.values(balance=User.balance + delta)
+                    .returning(User.balance)
+                    .execution_options(synchronize_session=False)
+                )).scalar_one_or_none()
+                if new_balance is None:
+                    return None
+                if ledger_type:
+                    session.add(LedgerEntry(user_id=user_id, type=ledger_type, amount=abs(delta)))
+        if self.user_cache is not None:
+            user = self.user_cache.peek(user_id)
+            if user is not None:
+                user.balance = new_balance
+        return new_balance
+
+    async def set_invited_by(self, user_id: int, referrer_id: int):
         async with self.async_session() as session:
-            await session.merge(user)
+            await session.execute(
+                update(User).where(User.user_id == user_id).values(invited_by=referrer_id)
+            )
             await session.commit()
+        if self.user_cache is not None:
+            user = self.user_cache.peek(user_id)
+            if user is not None:
+                user.invited_by = referrer_id
 
-    # Утилиты для работы с JSON-полями
-    @staticmethod
-    def get_referrals(user: User):
-        return json.loads(user.referrals) if user.referrals else []
+    async def enqueue_outbox(self, messages):
+        async with self.async_session() as session:
+            await session.execute(insert(OutboxMessage), outbox_rows(messages))
+            await session.commit()
 
-    @staticmethod
-    def set_referrals(user: User, referrals):
-        user.referrals = json.dumps(referrals)
+    def _cache_user(self, user: User):
+        if self.user_cache is not None:
+            self.user_cache.put(user)
 
-    @staticmethod
-    def get_history(user: User):
-        return json.loads(user.history) if user.history else []
+    def invalidate_user(self, user_id: int):
+        if self.user_cache is not None:
+            self.user_cache.invalidate(user_id)
 
-    @staticmethod
-    def set_history(user: User, history):
-        user.history = json.dumps(history)
+    def cache_stats(self) -> dict:
+        """Счётчики попаданий/промахов/вытеснений кэша пользователей"""
+        if self.user_cache is None:
+            return {"enabled": False}
+        return {"enabled": True, **self.user_cache.stats()}
 
-    async def process_withdrawal(self, user_id: int, amount: float, cryptopay) -> bool:
-        user = await self.get_user(user_id)
-        if user.balance < amount:
-            return False
+    async def add_referral(self, referrer_id: int, referee_id: int) -> bool:
+        """Один INSERT; повторное приглашение игнорируется. True — если запись добавлена"""
+        stmt = self._insert(Referral).values(
+            referrer_id=referrer_id, referee_id=referee_id, created_at=datetime.utcnow()
+        ).on_conflict_do_nothing(index_elements=['referrer_id', 'referee_id'])
+        async with self.async_session() as session:
+            result = await session.execute(stmt)
+            await session.commit()
+            return result.rowcount > 0
+
+    async def _count_rows(self, model) -> int:
+        async with self.async_session() as session:
+            result = await session.execute(select(func.count()).select_from(model))
+            return result.scalar_one()
+
+    async def backfill_referrals(self, batch_size: int = 500) -> int:
+        """Одноразовый перенос рефералов из users.referrals (JSON) и users.invited_by.
+
+        Дубликаты отбрасываются уникальным ограничением, поэтому повторный
+        запуск безопасен. Возвращает число добавленных пар.
+        """
+        async with self.engine.connect() as conn:
+            columns = await conn.run_sync(
+                lambda sync_conn: {c["name"] for c in inspect(sync_conn).get_columns("users")}
+            )
+        has_json = "referrals" in columns
+        has_invited_by = "invited_by" in columns
+        if not has_json and not has_invited_by:
+            logger.info("No legacy referral columns found, nothing to backfill")
+            return 0
+        before = await self._count_rows(Referral)
+        last_id = None
+        while True:
+            async with self.async_session() as session:
+                stmt = select(
+                    User.user_id,
+                    User.referrals if has_json else text("NULL"),
+                    User.invited_by if has_invited_by else text("NULL"),
+                ).order_by(User.user_id).limit(batch_size)
+                if last_id is not None:
+                    stmt = stmt.where(User.user_id > last_id)
+                rows = (await session.execute(stmt)).all()
+                if not rows:
+                    break
+                pairs = set()
+                for user_id, raw, invited_by in rows:
+                    if invited_by and invited_by != user_id:
+                        pairs.add((invited_by, user_id))
+                    if raw:
+                        try:
+                            referees = json.loads(raw)
+                        except ValueError:
+                            logger.warning(f"Skipping broken referrals JSON for user {user_id}")
+                            referees = []
+                        for rid in referees:
+                            if isinstance(rid, int) and rid != user_id:
+                                pairs.add((user_id, rid))
+                if pairs:
+                    now = datetime.utcnow()
+                    await session.execute(
+                        self._insert(Referral).on_conflict_do_nothing(
+                            index_elements=['referrer_id', 'referee_id']
+                        ),
+                        [{"referrer_id": a, "referee_id": b, "created_at": now} for a, b in sorted(pairs)],
+                    )
+                await session.commit()
+                last_id = rows[-1].user_id
+        added = await self._count_rows(Referral) - before
+        logger.info(f"Backfilled {added} referrals")
+        return added
+
+    async def iter_users(self, columns=("user_id", "lang"), batch_size: int = 1000, after_user_id=None):
+        """Потоковый обход users пачками по user_id (keyset-пагинация).
+
+        Выбираются только нужные столбцы; user_id добавляется всегда. Сессия
+        открывается на каждую пачку, поэтому соединение не держится во время
+        долгой обработки. Возвращает строки (Row) по одной.
+        """
+        columns = [getattr(User, c) if isinstance(c, str) else c for c in columns]
+        if "user_id" not in [c.key for c in columns]:
+            columns.insert(0, User.user_id)
+        last_id = after_user_id
+        while True:
+            stmt = select(*columns).order_by(User.user_id).limit(batch_size)
+            if last_id is not None:
+                stmt = stmt.where(User.user_id > last_id)
+            async with self.async_session() as session:
+                rows = (await session.execute(stmt)).all()
+            for row in rows:
+                yield row
+            if len(rows) < batch_size:
+                return
+            last_id = rows[-1].user_id
+
+    async def get_ledger(self, user_id: int, limit: int = 10):
+        """Последние операции пользователя, новые сначала"""
+        async with self.async_session() as session:
+            result = await session.execute(
+                select(LedgerEntry)
+                .where(LedgerEntry.user_id == user_id)
+                .order_by(LedgerEntry.created_at.desc(), LedgerEntry.id.desc())
+                .limit(limit)
+            )
+            return result.scalars().all()
+
+    async def migrate_history_to_ledger(self, batch_size: int = 500) -> int:
+        """Одноразовый перенос JSON-истории из users.history в таблицу ledger.
+
+        Переносит пачками по user_id, после переноса history очищается,
+        поэтому повторный запуск безопасен. Возвращает число перенесённых записей.
+        """
+        async with self.engine.connect() as conn:
+            columns = await conn.run_sync(
+                lambda sync_conn: {c["name"] for c in inspect(sync_conn).get_columns("users")}
+            )
+        if "history" not in columns:
+            logger.info("users.history column not found, nothing to migrate")
+            return 0
+        migrated = 0
+        last_id = None
+        while True:
+            async with self.async_session() as session:
+                stmt = (
+                    select(User.user_id, User.history)
+                    .where(User.history.isnot(None), User.history != '[]', User.history != '')
+                    .order_by(User.user_id)
+                    .limit(batch_size)
+                )
+                if last_id is not None:
+                    stmt = stmt.where(User.user_id > last_id)
+                rows = (await session.execute(stmt)).all()
+                if not rows:
+                    break
+                entries = []
+                for user_id, raw in rows:
+                    try:
+                        history = json.loads(raw)
+                    except ValueError:
+                        logger.warning(f"Skipping broken history JSON for user {user_id}")
+                        continue
+                    for h in history:
+                        if not isinstance(h, dict):
+                            continue
+                        entries.append({
+                            "user_id": user_id,
+                            "type": str(h.get("type", "unknown")),
+                            "amount": float(h.get("amount", 0) or 0),
+                            "tickets": h.get("tickets"),
+                            "draw_code": h.get("draw_code"),
+                            "ref_id": h.get("ref_id"),
+                            "created_at": datetime.utcnow(),
+                        })
+                if entries:
+                    await session.execute(insert(LedgerEntry), entries)
+                await session.execute(
+                    update(User)
+                    .where(User.user_id.in_([row.user_id for row in rows]))
+                    .values(history='[]')
+                )
+                await session.commit()
+                migrated += len(entries)
+                last_id = rows[-1].user_id
+        if self.user_cache is not None:
+            self.user_cache.clear()
+        logger.info(f"Migrated {migrated} history records to ledger")
+        return migrated
+
+    async def get_referral_stats(self, user_id: int, last_active: int = 3) -> dict:
+        """Статистика рефералов одним запросом (без создания пользователей)"""
+        purchases = func.coalesce(User.ref_purchases, 0)
+        is_active = case((purchases > 0, 1), else_=0)
+        stmt = (
+            select(
+                Referral.referee_id,
+                purchases.label("ref_purchases"),
+                func.count().over().label("total"),
+                func.sum(is_active).over().label("active"),
+                func.sum(purchases).over().label("purchases"),
+            )
+            .select_from(Referral)
+            .outerjoin(User, User.user_id == Referral.referee_id)
+            .where(Referral.referrer_id == user_id)
+            .order_by(is_active.desc(), Referral.created_at.desc(), Referral.id.desc())
+            .limit(max(last_active, 1))
+        )
+        async with self.async_session() as session:
+            rows = (await session.execute(stmt)).all()
+        if not rows:
+            return {"total": 0, "active": 0, "total_purchases": 0, "last_active": []}
+        first = rows[0]
+        last = [row.referee_id for row in rows[:last_active] if row.ref_purchases > 0]
+        return {
+            "total": first.total,
+            "active": int(first.active or 0),
+            "total_purchases": int(first.purchases or 0),
+            "last_active": last[::-1],
+        }
+
+    async def process_withdrawal(self, user_id: int, amount: float, cryptopay, messages=None) -> bool:
+        """Списание, перевод через CryptoPay и сообщения в outbox после успешного перевода.
+
+        Баланс списывается условным UPDATE до перевода — параллельная покупка или
+        вывод на другой реплике не уведут его в минус. Перевод не прошёл — возврат.
+        """
         transfer_amount = amount - 0.1  # комиссия
         if transfer_amount <= 0:
             return False
+        if await self.change_balance(user_id, -amount, ledger_type="withdraw", require_funds=True) is None:
+            return False
         result = await cryptopay.transfer(
             user_id=user_id,
             amount=transfer_amount,
             comment="Вывод средств из лотерейного бота"
         )
-        if result.get("ok"):
-            user.balance -= amount
-            await self.update_user(user)
-            return True
-        return False
+        if not result.get("ok"):
+            await self.change_balance(user_id, amount, ledger_type="withdraw_refund")
+            logger.warning("withdrawal refunded user_id=%s amount=%s error=%s", user_id, amount, result.get("error"))
+            return False
+        if messages:
+            await self.enqueue_outbox(messages)
+        return True
+
+    async def purchase_tickets(self, user_id: int, tickets: int, price: float, draw_id: int):
+        """Покупка билетов в тираж draw_id одной транзакцией.
+
+        Списание баланса — условный UPDATE в SQL (без овердрафта при параллельных
+        нажатиях), участие в тираже — upsert, плюс запись в журнал.
+        Возвращает новый баланс или None, если средств недостаточно.
+        DrawClosedError — тираж успели закрыть, ничего не списано.
+        """
+        async with self.async_session() as session:
+            async with session.begin():
+                # Блокировка строки тиража по ключу: settle_draw дождётся этой покупки
+                still_active = (await session.execute(
+                    select(Draw.id)
+                    .where(Draw.id == draw_id, Draw.is_active == True)
+                    .with_for_update(read=True)
+                )).scalar_one_or_none()
+                if still_active is None:
+                    raise DrawClosedError(draw_id)
+                result = await session.execute(
+                    update(User)
+                    .where(User.user_id == user_id, User.balance >= price)
+                    .values(
+                        balance=User.balance - price,
+                        ref_purchases=func.coalesce(User.ref_purchases, 0) + 1,
+                    )
+                    .returning(User.balance, User.ref_purchases)
+                    .execution_options(synchronize_session=False)
+                )
+                row = result.first()
+                if row is None:
+                    return None
+                stmt = self._insert(DrawEntry).values(draw_id=draw_id, user_id=user_id, tickets=tickets)
+                await session.execute(stmt.on_conflict_do_update(
+                    index_elements=['draw_id', 'user_id'],
+                    set_={"tickets": DrawEntry.tickets + stmt.excluded.tickets},
+                ))
+                session.add(LedgerEntry(user_id=user_id, type="game", tickets=tickets, amount=-price))
+        if self.user_cache is not None:
+            user = self.user_cache.peek(user_id)
+            if user is not None:
+                user.balance, user.ref_purchases = row.balance, row.ref_purchases
+        return row.balance
 
     async def update_user_language(self, user_id: int, lang: str):
         async with self.async_session() as session:
@@ -116,12 +727,293 @@ class AsyncDatabase:
                 update(User).where(User.user_id == user_id).values(lang=lang)
             )
             await session.commit()
+        if self.user_cache is not None:
+            user = self.user_cache.peek(user_id)
+            if user is not None:
+                user.lang = lang
+
+    async def add_invoice(self, invoice_id: int, user_id: int, amount: float, status: str = 'active'):
+        """Сохраняет счёт; уже сохранённый не трогает.
+
+        status='paid' — счёт оплачен без зачисления (импорт старого счёта).
+        """
+        now = datetime.utcnow()
+        async with self.async_session() as session:
+            await session.execute(
+                self._insert(Invoice).values(
+                    invoice_id=invoice_id, user_id=user_id, amount=amount, status=status,
+                    created_at=now, paid_at=now if status == 'paid' else None,
+                ).on_conflict_do_nothing(index_elements=['invoice_id'])
+            )
+            await session.commit()
+
+    async def get_invoice(self, invoice_id: int):
+        async with self.async_session() as session:
+            return await session.get(Invoice, invoice_id)
+
+    async def get_pending_invoice_ids(self, limit: int = 1000):
+        async with self.async_session() as session:
+            result = await session.execute(
+                select(Invoice.invoice_id)
+                .where(Invoice.status == 'active')
+                .order_by(Invoice.created_at)
+                .limit(limit)
+            )
+            return result.scalars().all()
+
+    async def mark_invoice_paid(self, invoice_id: int, amount: float, build_messages=None):
+        """Зачисляет оплаченный счёт ровно один раз.
+
+        Переход active -> paid — условный UPDATE; баланс, журнал и сообщения
+        build_messages(user_id, lang) в outbox пишутся только если переход удался.
+        Возвращает Invoice или None, если счёт уже обработан.
+        """
+        async with self.async_session() as session:
+            async with session.begin():
+                result = await session.execute(
+                    update(Invoice)
+                    .where(Invoice.invoice_id == invoice_id, Invoice.status == 'active')
+                    .values(status='paid', amount=amount, paid_at=datetime.utcnow())
+                    .returning(Invoice.user_id)
+                    .execution_options(synchronize_session=False)
+                )
+                user_id = result.scalar_one_or_none()
+                if user_id is None:
+                    return None
+                lang = (await session.execute(
+                    update(User)
+                    .where(User.user_id == user_id)
+                    .values(balance=User.balance + amount)
+                    .returning(User.lang)
+                    .execution_options(synchronize_session=False)
+                )).scalar_one_or_none()
+                session.add(LedgerEntry(user_id=user_id, type="deposit", amount=amount))
+                if build_messages is not None:
+                    await session.execute(insert(OutboxMessage), outbox_rows(build_messages(user_id, lang)))
+        self.invalidate_user(user_id)
+        return Invoice(invoice_id=invoice_id, user_id=user_id, amount=amount, status='paid')
+
+    async def set_invoice_status(self, invoice_id: int, status: str):
+        """Переводит неоплаченный счёт в конечный статус (expired)"""
+        async with self.async_session() as session:
+            await session.execute(
+                update(Invoice)
+                .where(Invoice.invoice_id == invoice_id, Invoice.status == 'active')
+                .values(status=status)
+            )
+            await session.commit()
+
+    async def fetch_outbox(self, limit: int = 200):
+        """Готовые к отправке сообщения по порядку id.
+
+        Сообщение не выдаётся, пока более раннее сообщение того же чата ждёт
+        повторной попытки — так сохраняется порядок внутри чата.
+        """
+        now = datetime.utcnow()
+        earlier = aliased(OutboxMessage)
+        async with self.async_session() as session:
+            result = await session.execute(
+                select(OutboxMessage)
+                .where(
+                    OutboxMessage.status == 'pending',
+                    OutboxMessage.next_attempt_at <= now,
+                    ~exists().where(
+                        earlier.chat_id == OutboxMessage.chat_id,
+                        earlier.status == 'pending',
+                        earlier.id < OutboxMessage.id,
+                        earlier.next_attempt_at > now,
+                    ),
+                )
+                .order_by(OutboxMessage.id)
+                .limit(limit)
+            )
+            return result.scalars().all()
+
+    async def complete_outbox(self, ids):
+        """Отправленные сообщения удаляются — таблица остаётся маленькой"""
+        if not ids:
+            return
+        async with self.async_session() as session:
+            await session.execute(delete(OutboxMessage).where(OutboxMessage.id.in_(ids)))
+            await session.commit()
+
+    async def set_outbox_status(self, ids, status: str):
+        """Финальный статус failed/blocked; next_attempt_at — время, от которого считается хранение"""
+        if not ids:
+            return
+        async with self.async_session() as session:
+            await session.execute(
+                update(OutboxMessage).where(OutboxMessage.id.in_(ids))
+                .values(status=status, next_attempt_at=datetime.utcnow())
+            )
+            await session.commit()
+
+    async def purge_outbox(self, older_than: float) -> int:
+        """Удаляет неотправленные сообщения (failed/blocked) старше older_than секунд"""
+        async with self.async_session() as session:
+            result = await session.execute(
+                delete(OutboxMessage).where(
+                    OutboxMessage.status.in_(['failed', 'blocked']),
+                    OutboxMessage.next_attempt_at <= datetime.utcnow() - timedelta(seconds=older_than),
+                )
+            )
+            await session.commit()
+            return result.rowcount
+
+    async def retry_outbox(self, message_id: int, attempts: int, delay: float):
+        async with self.async_session() as session:
+            await session.execute(
+                update(OutboxMessage).where(OutboxMessage.id == message_id).values(
+                    attempts=attempts, next_attempt_at=datetime.utcnow() + timedelta(seconds=delay),
+                )
+            )
+            await session.commit()
+
+    async def claim_broadcast(self, name: str, kind: str, params: dict, holder: str, stale_after: float):
+        """Создаёт рассылку или забирает незавершённую, чей владелец не подавал пульс stale_after секунд.
+
+        Возвращает Broadcast или None — рассылка завершена или её ведёт другой процесс.
+        """
+        now = datetime.utcnow()
+        async with self.async_session() as session:
+            async with session.begin():
+                created = (await session.execute(
+                    self._insert(Broadcast).values(
+                        name=name, kind=kind, params=json.dumps(params), delivered=0, blocked=0, failed=0,
+                        status='running', holder=holder, created_at=now, updated_at=now,
+                    ).on_conflict_do_nothing(index_elements=['name'])
+                )).rowcount
+                if not created:
+                    claimed = (await session.execute(
+                        update(Broadcast)
+                        .where(
+                            Broadcast.name == name,
+                            Broadcast.status == 'running',
+                            Broadcast.holder.is_(None) | (Broadcast.updated_at < now - timedelta(seconds=stale_after)),
+                        )
+                        .values(holder=holder, updated_at=now)
+                    )).rowcount
+                    if not claimed:
+                        return None
+            return await session.get(Broadcast, name)
+
+    async def save_broadcast_progress(self, name: str, holder: str, last_user_id, delivered: int, blocked: int,
+                                      failed: int, status: str = 'running'):
+        """Сохраняет позицию и продлевает пульс; BroadcastTakenOverError — владелец сменился"""
+        async with self.async_session() as session:
+            updated = (await session.execute(
+                update(Broadcast).where(Broadcast.name == name, Broadcast.holder == holder).values(
+                    last_user_id=last_user_id, delivered=delivered, blocked=blocked,
+                    failed=failed, status=status, updated_at=datetime.utcnow(),
+                )
+            )).rowcount
+            await session.commit()
+        if not updated:
+            raise BroadcastTakenOverError(name)
+
+    async def touch_broadcast(self, name: str, holder: str):
+        """Пульс владельца между сохранениями позиции"""
+        async with self.async_session() as session:
+            updated = (await session.execute(
+                update(Broadcast).where(Broadcast.name == name, Broadcast.holder == holder)
+                .values(updated_at=datetime.utcnow())
+            )).rowcount
+            await session.commit()
+        if not updated:
+            raise BroadcastTakenOverError(name)
+
+    async def get_unfinished_broadcasts(self):
+        async with self.async_session() as session:
+            result = await session.execute(select(Broadcast).where(Broadcast.status == 'running'))
+            return result.scalars().all()
+
+    async def acquire_lease(self, name: str, holder: str, ttl: float) -> bool:
+        """Берёт или продлевает аренду одним атомарным запросом.
+
+        Удаётся, если аренды нет, она уже у holder или истекла. Срок считается
+        по часам процессов, поэтому часы реплик должны быть синхронизированы.
+        """
+        now = datetime.utcnow()
+        stmt = self._insert(Lease).values(name=name, holder=holder, expires_at=now + timedelta(seconds=ttl))
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[Lease.name],
+            set_={"holder": stmt.excluded.holder, "expires_at": stmt.excluded.expires_at},
+            where=(Lease.holder == holder) | (Lease.expires_at < now),
+        )
+        async with self.async_session() as session:
+            result = await session.execute(stmt)
+            await session.commit()
+            return result.rowcount > 0
+
+    async def release_lease(self, name: str, holder: str):
+        """Отдаёт аренду сразу, не дожидаясь истечения срока"""
+        async with self.async_session() as session:
+            await session.execute(delete(Lease).where(Lease.name == name, Lease.holder == holder))
+            await session.commit()
+
+    async def get_fsm_record(self, key: str):
+        """(state, data) для ключа FSM или None, если записи нет или она истекла"""
+        async with self.async_session() as session:
+            result = await session.execute(
+                select(FsmRecord.state, FsmRecord.data)
+                .where(FsmRecord.key == key, FsmRecord.expires_at > datetime.utcnow())
+            )
+            row = result.first()
+            if row is None:
+                return None
+            return row.state, json.loads(row.data or '{}')
+
+    async def save_fsm_field(self, key: str, field: str, value, ttl: float):
+        """Записывает только state или только data — запись другой реплики во второе поле не затирается.
+
+        Пустое значение (state None, data {}) строку не создаёт: запись
+        удаляется, если второе поле тоже пусто или истекло, иначе обновляется.
+        """
+        now = datetime.utcnow()
+        expires_at = now + timedelta(seconds=ttl)
+        defaults = {"state": None, "data": '{}'}
+        other = "data" if field == "state" else "state"
+        if value is None or value == {}:
+            other_column = getattr(FsmRecord, other)
+            other_empty = other_column.is_(None) if other == "state" else other_column == defaults[other]
+            async with self.async_session() as session:
+                result = await session.execute(
+                    delete(FsmRecord).where(FsmRecord.key == key, or_(other_empty, FsmRecord.expires_at <= now))
+                )
+                if not result.rowcount:
+                    await session.execute(
+                        update(FsmRecord).where(FsmRecord.key == key)
+                        .values(**{field: defaults[field], "expires_at": expires_at})
+                    )
+                await session.commit()
+            return
+        if field == "data":
+            value = json.dumps(value)
+        stmt = self._insert(FsmRecord).values(**{"key": key, **defaults, field: value, "expires_at": expires_at})
+        stmt = stmt.on_conflict_do_update(index_elements=[FsmRecord.key], set_={
+            field: value,
+            # Второе поле истёкшей записи не воскрешаем
+            other: case((FsmRecord.expires_at <= now, defaults[other]), else_=getattr(FsmRecord, other)),
+            "expires_at": expires_at,
+        })
+        async with self.async_session() as session:
+            await session.execute(stmt)
+            await session.commit()
+
+    async def purge_expired_fsm(self) -> int:
+        async with self.async_session() as session:
+            result = await session.execute(delete(FsmRecord).where(FsmRecord.expires_at <= datetime.utcnow()))
+            await session.commit()
+            return result.rowcount
 
     async def get_active_draw(self):
         async with self.async_session() as session:
             now = datetime.utcnow()
             result = await session.execute(
-                select(Draw).where(Draw.is_active == True, Draw.end_time > now)
+                select(Draw)
+                .where(Draw.is_active == True, Draw.end_time > now)
+                .order_by(Draw.end_time.desc())
+                .limit(1)
             )
             draw = result.scalar_one_or_none()
             return draw
@@ -140,31 +1032,55 @@ class AsyncDatabase:
     def _generate_draw_code(self):
         return ''.join(random.choices(string.ascii_uppercase + string.digits, k=6))
 
-    async def add_entry(self, draw_id, user_id, tickets=1):
-        async with self.async_session() as session:
-            entry = await session.execute(
-                select(DrawEntry).where(DrawEntry.draw_id == draw_id, DrawEntry.user_id == user_id)
-            )
-            entry = entry.scalar_one_or_none()
-            if entry:
-                entry.tickets += tickets
-            else:
-                entry = DrawEntry(draw_id=draw_id, user_id=user_id, tickets=tickets)
-                session.add(entry)
-            await session.commit()
-
-    async def finish_draw(self, draw: Draw):
-        async with self.async_session() as session:
-            draw.is_active = False
-            await session.merge(draw)
-            await session.commit()
+    async def settle_draw(self, draw, compute_prizes, build_messages=None):
+        """Закрывает тираж и начисляет выигрыши одной транзакцией.
 
-    async def get_draw_entries(self, draw_id):
+        compute_prizes получает список (user_id, tickets) и возвращает {user_id: сумма}.
+        Все начисления — один пакетный UPDATE и один пакетный INSERT в журнал.
+        build_messages(winnings, langs) — уведомления в outbox в той же транзакции.
+        Возвращает (winnings, {user_id: lang}) или None, если тираж уже закрыт.
+        """
+        users = User.__table__
         async with self.async_session() as session:
-            result = await session.execute(
-                select(DrawEntry).where(DrawEntry.draw_id == draw_id)
-            )
-            return result.scalars().all()
+            async with session.begin():
+                closed = await session.execute(
+                    update(Draw)
+                    .where(Draw.id == draw.id, Draw.is_active == True)
+                    .values(is_active=False)
+                    .execution_options(synchronize_session=False)
+                )
+                if closed.rowcount == 0:
+                    return None
+                # Участников читаем уже после закрытия — новых билетов в тираж не попадёт
+                entries = (await session.execute(
+                    select(DrawEntry.user_id, DrawEntry.tickets).where(DrawEntry.draw_id == draw.id)
+                )).all()
+                winnings = compute_prizes(entries)
+                if winnings:
+                    await session.execute(
+                        update(users)
+                        .where(users.c.user_id == bindparam("b_user_id"))
+                        .values(balance=users.c.balance + bindparam("b_amount")),
+                        [{"b_user_id": uid, "b_amount": amount} for uid, amount in winnings.items()],
+                    )
+                    now = datetime.utcnow()
+                    await session.execute(insert(LedgerEntry), [
+                        {"user_id": uid, "type": "win", "amount": amount,
+                         "draw_code": draw.code, "created_at": now}
+                        for uid, amount in winnings.items()
+                    ])
+                langs = dict((await session.execute(
+                    select(User.user_id, User.lang)
+                    .join(DrawEntry, DrawEntry.user_id == User.user_id)
+                    .where(DrawEntry.draw_id == draw.id)
+                )).all())
+                messages = build_messages(winnings, langs) if build_messages and winnings else None
+                if messages:
+                    await session.execute(insert(OutboxMessage), outbox_rows(messages))
+        if self.user_cache is not None:
+            for uid in winnings:
+                self.user_cache.invalidate(uid)
+        return winnings, langs
 
     async def get_draw_by_code(self, code):
         async with self.async_session() as session:
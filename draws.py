@@ -0,0 +1,78 @@
+"""Текущий тираж в памяти процесса"""
+import asyncio
+import time
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Optional
+
+@dataclass(frozen=True)
+class ActiveDraw:
+    id: int
+    code: str
+    end_time: datetime
+
+class NoActiveDrawError(Exception):
+    """Лидер не открыл новый тираж за отведённое время"""
+
+class DrawRegistry:
+    """Текущий тираж без обращений к БД на каждую покупку.
+
+    Планировщик меняет тираж через rollover(), покупки читают current()/get().
+    Создание тиража идёт под одной блокировкой (single-flight), поэтому при
+    смене тиража создаётся ровно один новый.
+    Тиражи создаёт только реплика с create=True (лидер); остальные ждут,
+    пока новый тираж появится в БД.
+    """
+
+    def __init__(self, db, duration_minutes: float, create: bool = True, wait_timeout: float = 5.0):
+        self.db = db
+        self.duration_minutes = duration_minutes
+        self.create = create
+        self.wait_timeout = wait_timeout
+        self._current: Optional[ActiveDraw] = None
+        self._lock = asyncio.Lock()
+
+    def set(self, draw) -> ActiveDraw:
+        # Замена ссылки атомарна для всех корутин процесса
+        self._current = ActiveDraw(id=draw.id, code=draw.code, end_time=draw.end_time)
+        return self._current
+
+    def current(self) -> Optional[ActiveDraw]:
+        """Текущий тираж, если он ещё не закончился (без I/O)"""
+        draw = self._current
+        if draw is not None and draw.end_time > datetime.utcnow():
+            return draw
+        return None
+
+    async def get(self) -> ActiveDraw:
+        """Текущий тираж; если его нет — берёт активный из БД или создаёт новый"""
+        draw = self.current()
+        if draw is not None:
+            return draw
+        async with self._lock:
+            draw = self.current()
+            if draw is not None:
+                return draw
+            found = await self.db.get_active_draw()
+            if found is None:
+                found = await self._open()
+            return self.set(found)
+
+    async def rollover(self, closed: ActiveDraw) -> ActiveDraw:
+        """Открывает тираж на смену closed, если его ещё не открыли покупки"""
+        async with self._lock:
+            draw = self._current
+            if draw is not None and draw.id != closed.id and draw.end_time > datetime.utcnow():
+                return draw
+            return self.set(await self._open())
+
+    async def _open(self):
+        if self.create:
+            return await self.db.create_new_draw(duration_minutes=self.duration_minutes)
+        deadline = time.monotonic() + self.wait_timeout
+        while time.monotonic() < deadline:
+            await asyncio.sleep(0.2)
+            found = await self.db.get_active_draw()
+            if found is not None:
+                return found
+        raise NoActiveDrawError()
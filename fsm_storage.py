@@ -0,0 +1,96 @@
+"""Хранилище FSM aiogram в базе бота: переживает перезапуск и общее для реплик"""
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+from aiogram import Bot
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StorageKey, StateType
+
+logger = logging.getLogger(__name__)
+
+_UNCHANGED = object()
+
+class DatabaseStorage(BaseStorage):
+    """FSM-хранилище поверх AsyncDatabase (таблица fsm_states).
+
+    Состояние читается на каждом апдейте, поэтому перед БД стоит LRU-кэш
+    на cache_ttl секунд. Реплики видят изменения друг друга не позже чем
+    через cache_ttl (cache_ttl=0 — всегда читать из БД). Запись идёт в БД
+    всегда и меняет только своё поле (state или data): решение по кэшу
+    могло бы пропустить clear() после записи другой реплики. Записи живут
+    ttl секунд с последнего изменения.
+    """
+
+    def __init__(self, db, ttl: float = 86400, cache_ttl: float = 2.0, cache_size: int = 10000,
+                 purge_interval: float = 600):
+        self.db = db
+        self.ttl = ttl
+        self.cache_ttl = cache_ttl
+        self.cache_size = cache_size
+        self.purge_interval = purge_interval
+        self._cache = OrderedDict()  # key -> (expires_at, state, data)
+        self._purged_at = time.monotonic()
+
+    @staticmethod
+    def _key(key: StorageKey) -> str:
+        return f"{key.bot_id}:{key.chat_id}:{key.user_id}:{key.destiny}"
+
+    async def _load(self, key: str):
+        item = self._cache.get(key)
+        if item is not None and item[0] > time.monotonic():
+            self._cache.move_to_end(key)
+            return item[1], item[2]
+        record = await self.db.get_fsm_record(key)
+        state, data = record if record is not None else (None, {})
+        self._remember(key, state, data)
+        return state, data
+
+    def _remember(self, key: str, state, data: dict):
+        if self.cache_ttl <= 0:
+            return
+        self._cache[key] = (time.monotonic() + self.cache_ttl, state, data)
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def _update_cache(self, key: str, state=_UNCHANGED, data=_UNCHANGED):
+        """Меняет в кэше записанную половину; срок записи не продлевается"""
+        item = self._cache.get(key)
+        if item is None or item[0] <= time.monotonic():
+            self._cache.pop(key, None)
+            return
+        self._cache[key] = (item[0], item[1] if state is _UNCHANGED else state, item[2] if data is _UNCHANGED else data)
+
+    async def _write(self, key: str, field: str, value):
+        # Пишем всегда: кэш может отставать от записи другой реплики на cache_ttl
+        await self.db.save_fsm_field(key, field, value, self.ttl)
+        if time.monotonic() - self._purged_at > self.purge_interval:
+            self._purged_at = time.monotonic()
+            purged = await self.db.purge_expired_fsm()
+            if purged:
+                logger.info("expired fsm states purged count=%s", purged)
+
+    async def set_state(self, bot: Bot, key: StorageKey, state: StateType = None) -> None:
+        state = state.state if isinstance(state, State) else state
+        storage_key = self._key(key)
+        await self._write(storage_key, "state", state)
+        self._update_cache(storage_key, state=state)
+
+    async def get_state(self, bot: Bot, key: StorageKey) -> Optional[str]:
+        state, _ = await self._load(self._key(key))
+        return state
+
+    async def set_data(self, bot: Bot, key: StorageKey, data: Dict[str, Any]) -> None:
+        storage_key = self._key(key)
+        data = data.copy()
+        await self._write(storage_key, "data", data)
+        self._update_cache(storage_key, data=data)
+
+    async def get_data(self, bot: Bot, key: StorageKey) -> Dict[str, Any]:
+        _, data = await self._load(self._key(key))
+        return data.copy()
+
+    async def close(self) -> None:
+        # Движок БД закрывает stop_services()
+        self._cache.clear()
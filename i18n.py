@@ -0,0 +1,45 @@
+"""Скомпилированные переводы: таблица на каждый язык, проверка при загрузке"""
+from string import Formatter
+
+class Translations:
+    """Переводы, разложенные по языкам один раз при запуске.
+
+    Строки без подстановок хранятся готовыми и отдаются без str.format,
+    для шаблонов хранится связанный метод format. Ключ без перевода на
+    один из языков или с разными подстановками в языках — ошибка загрузки.
+    """
+
+    def __init__(self, table: dict, langs=("ru", "en"), default: str = "ru"):
+        self.langs = tuple(langs)
+        self.default = default
+        self._tables = {lang: {} for lang in self.langs}
+        errors = []
+        for key, variants in table.items():
+            missing = [lang for lang in self.langs if lang not in variants]
+            if missing:
+                errors.append(f"{key}: no {', '.join(missing)}")
+                continue
+            fields = {lang: self._fields(variants[lang]) for lang in self.langs}
+            if len({frozenset(f) for f in fields.values()}) > 1:
+                errors.append(f"{key}: placeholders differ {fields}")
+                continue
+            for lang in self.langs:
+                text = variants[lang]
+                if fields[lang]:
+                    self._tables[lang][key] = text.format
+                else:
+                    # "{{" в статической строке — обычная скобка
+                    self._tables[lang][key] = "".join(literal for literal, *_ in Formatter().parse(text))
+        if errors:
+            raise ValueError("Invalid translations:\n" + "\n".join(errors))
+
+    @staticmethod
+    def _fields(text: str) -> set:
+        return {field.split(".")[0].split("[")[0].split("!")[0]
+                for _, field, _, _ in Formatter().parse(text) if field is not None}
+
+    def __call__(self, key: str, lang: str, **kwargs) -> str:
+        entry = self._tables.get(lang, self._tables[self.default])[key]
+        if isinstance(entry, str):
+            return entry
+        return entry(**kwargs)
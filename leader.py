@@ -0,0 +1,78 @@
+"""Выбор лидера среди реплик бота через аренду в БД"""
+import asyncio
+import logging
+import os
+import socket
+import time
+from uuid import uuid4
+
+logger = logging.getLogger(__name__)
+
+class LeaderElector:
+    """Запускает job() только в той реплике, которая держит аренду name.
+
+    Лидер продлевает аренду каждые renew_interval секунд. Если лидер пропал,
+    аренда истекает через ttl и резервная реплика забирает её на следующей
+    попытке — переключение занимает не больше ttl + renew_interval.
+    job — фабрика корутины; при потере лидерства её задача отменяется.
+    """
+
+    def __init__(self, db, name: str, job, ttl: float = 15.0, renew_interval: float = 5.0):
+        self.db = db
+        self.name = name
+        self.job = job
+        self.ttl = ttl
+        self.renew_interval = renew_interval
+        self.holder = f"{socket.gethostname()}:{os.getpid()}:{uuid4().hex[:8]}"
+        self._job_task = None
+        self._renewed_at = 0.0
+
+    @property
+    def is_leader(self) -> bool:
+        return self._job_task is not None
+
+    async def run(self):
+        logger.info("leader election started name=%s holder=%s", self.name, self.holder)
+        try:
+            while True:
+                await self._tick()
+                await asyncio.sleep(self.renew_interval)
+        finally:
+            await self._step_down()
+
+    async def _tick(self):
+        try:
+            acquired = await self.db.acquire_lease(self.name, self.holder, self.ttl)
+        except Exception as e:
+            logger.warning("lease renewal failed name=%s error=%s", self.name, e)
+            # Без БД лидерство держим, пока аренда заведомо не истекла
+            acquired = self.is_leader and time.monotonic() - self._renewed_at < self.ttl - self.renew_interval
+        else:
+            if acquired:
+                self._renewed_at = time.monotonic()
+        if acquired and (self._job_task is None or self._job_task.done()):
+            if self._job_task is not None:
+                error = None if self._job_task.cancelled() else self._job_task.exception()
+                logger.error("leader job exited, restarting name=%s error=%r", self.name, error)
+            else:
+                logger.info("became leader name=%s holder=%s", self.name, self.holder)
+            self._job_task = asyncio.create_task(self.job())
+        elif not acquired and self.is_leader:
+            logger.warning("lost leadership name=%s holder=%s", self.name, self.holder)
+            await self._cancel_job()
+
+    async def _cancel_job(self):
+        task, self._job_task = self._job_task, None
+        if task is not None:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+    async def _step_down(self):
+        was_leader = self.is_leader
+        await self._cancel_job()
+        if was_leader:
+            # Резервная реплика подхватит задачи сразу, не дожидаясь ttl
+            try:
+                await self.db.release_lease(self.name, self.holder)
+            except Exception as e:
+                logger.warning("lease release failed name=%s error=%s", self.name, e)
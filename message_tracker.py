@@ -0,0 +1,67 @@
+"""Последнее сообщение бота в каждом чате: id, вид и хеш содержимого"""
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Optional
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.methods import SendMessage, SendSticker, EditMessageText, DeleteMessage
+from aiogram.types import Message
+
+STICKER = "sticker"
+FINAL = "final"  # итог операции (пополнение, вывод) — не перезаписываем, отвечаем новым сообщением
+MENU = "menu"
+
+@dataclass
+class LastMessage:
+    message_id: int
+    kind: str
+    content_hash: Optional[int] = None
+
+def content_hash(text: str, reply_markup=None) -> int:
+    return hash((text, reply_markup.json() if reply_markup is not None else None))
+
+class MessageTracker:
+    """LRU по чатам; заполняется middleware сессии бота при каждой отправке и правке"""
+
+    def __init__(self, maxsize: int = 100000):
+        self.maxsize = maxsize
+        self._chats = OrderedDict()  # chat_id -> LastMessage
+
+    def get(self, chat_id: int, message_id: int) -> Optional[LastMessage]:
+        """Запись, если message_id — последнее известное сообщение бота в чате"""
+        last = self._chats.get(chat_id)
+        if last is None or last.message_id != message_id:
+            return None
+        return last
+
+    def record(self, chat_id: int, message_id: int, kind: str, content_hash: Optional[int] = None):
+        self._chats[chat_id] = LastMessage(message_id, kind, content_hash)
+        self._chats.move_to_end(chat_id)
+        while len(self._chats) > self.maxsize:
+            self._chats.popitem(last=False)
+
+    def mark_final(self, message: Message):
+        last = self._chats.get(message.chat.id)
+        if last is not None and last.message_id == message.message_id:
+            last.kind = FINAL
+
+    def forget(self, chat_id: int, message_id: int):
+        last = self._chats.get(chat_id)
+        if last is not None and last.message_id == message_id:
+            del self._chats[chat_id]
+
+class MessageTrackerMiddleware(BaseRequestMiddleware):
+    """Middleware сессии бота: запоминает результат sendMessage/sendSticker/editMessageText"""
+
+    def __init__(self, tracker: MessageTracker):
+        self.tracker = tracker
+
+    async def __call__(self, make_request, bot, method):
+        result = await make_request(bot, method)
+        if isinstance(method, (SendMessage, EditMessageText)) and isinstance(result, Message):
+            self.tracker.record(result.chat.id, result.message_id, MENU,
+                                content_hash(method.text, method.reply_markup))
+        elif isinstance(method, SendSticker) and isinstance(result, Message):
+            self.tracker.record(result.chat.id, result.message_id, STICKER)
+        elif isinstance(method, DeleteMessage):
+            self.tracker.forget(method.chat_id, method.message_id)
+        return result
@@ -0,0 +1,209 @@
+"""Метрики обработчиков в формате Prometheus"""
+import bisect
+import contextvars
+import logging
+import time
+from typing import Optional
+from aiohttp import web
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from sqlalchemy import event
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21)
+
+def _format_labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    parts = []
+    for key, value in labels.items():
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        parts.append(f'{key}="{value}"')
+    return "{" + ",".join(parts) + "}"
+
+class Counter:
+    def __init__(self, name: str, help: str, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+
+    def inc(self, value: float = 1, **labels):
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        self._values[key] = self._values.get(key, 0) + value
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        for key, value in self._values.items():
+            yield f"{self.name}{_format_labels(dict(zip(self.labelnames, key)))} {value}"
+
+class Histogram:
+    def __init__(self, name: str, help: str, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._values = {}  # labels -> [счётчики по корзинам, сумма, количество]
+
+    def observe(self, value: float, **labels):
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        item = self._values.get(key)
+        if item is None:
+            item = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            item[0][index] += 1
+        item[1] += value
+        item[2] += 1
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        for key, (counts, total, count) in self._values.items():
+            labels = dict(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                yield f"{self.name}_bucket{_format_labels({**labels, 'le': bound})} {cumulative}"
+            yield f"{self.name}_bucket{_format_labels({**labels, 'le': '+Inf'})} {count}"
+            yield f"{self.name}_sum{_format_labels(labels)} {total}"
+            yield f"{self.name}_count{_format_labels(labels)} {count}"
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def collector(self, func):
+        """func() -> [(name, type, help, [(labels, value), ...]), ...] — значения на момент запроса"""
+        self._collectors.append(func)
+        return func
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        for func in self._collectors:
+            try:
+                families = func()
+            except Exception as e:
+                logger.warning(f"Metrics collector {func.__name__} failed: {e}")
+                continue
+            for name, kind, help, samples in families:
+                lines.append(f"# HELP {name} {help}")
+                lines.append(f"# TYPE {name} {kind}")
+                for labels, value in samples:
+                    lines.append(f"{name}{_format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+REGISTRY = Registry()
+
+update_duration = REGISTRY.register(Histogram(
+    "bot_update_duration_seconds", "Update handling latency", ["handler"]))
+update_db_sessions = REGISTRY.register(Histogram(
+    "bot_update_db_sessions", "DB connections checked out per update", ["handler"], buckets=COUNT_BUCKETS))
+update_api_calls = REGISTRY.register(Histogram(
+    "bot_update_api_calls", "Telegram API calls per update", ["handler"], buckets=COUNT_BUCKETS))
+update_errors = REGISTRY.register(Counter(
+    "bot_update_errors_total", "Updates whose handler raised", ["handler"]))
+db_sessions_total = REGISTRY.register(Counter(
+    "bot_db_sessions_total", "DB connections checked out"))
+api_calls_total = REGISTRY.register(Counter(
+    "bot_telegram_api_calls_total", "Telegram API calls", ["method"]))
+
+class UpdateStats:
+    __slots__ = ("handler", "db_sessions", "api_calls")
+
+    def __init__(self, handler: str):
+        self.handler = handler
+        self.db_sessions = 0
+        self.api_calls = 0
+
+# Статистика текущего апдейта (наследуется задачами и greenlet'ами SQLAlchemy)
+_current_update = contextvars.ContextVar("current_update", default=None)
+
+def current_handler() -> Optional[str]:
+    stats = _current_update.get()
+    return stats.handler if stats is not None else None
+
+def update_key(update, commands=frozenset(), callbacks=frozenset(), callback_prefixes=()) -> str:
+    """Ключ обработчика из фиксированного набора: известная команда или callback_data.
+
+    Всё остальное (в callback_data и тексте команды приходит что угодно) — "other",
+    иначе число меток не ограничено.
+    """
+    if update.callback_query is not None:
+        data = update.callback_query.data or ""
+        if data in callbacks:
+            return "cb:" + data
+        prefix = next((p for p in callback_prefixes if data.startswith(p)), None)
+        return "cb:" + prefix if prefix is not None else "cb:other"
+    message = update.message
+    if message is not None:
+        if message.text and message.text.startswith("/"):
+            command = message.text.split()[0].split("@")[0][1:]
+            return "/" + command if command in commands else "/other"
+        return "message"
+    return update.event_type
+
+class MetricsMiddleware(BaseMiddleware):
+    """Внешний middleware на dp.update: задержка, сессии БД и вызовы API на апдейт"""
+
+    def __init__(self, commands=(), callbacks=(), callback_prefixes=()):
+        self.commands = frozenset(commands)
+        self.callbacks = frozenset(callbacks)
+        self.callback_prefixes = tuple(callback_prefixes)
+
+    async def __call__(self, handler, event, data):
+        stats = UpdateStats(update_key(event, self.commands, self.callbacks, self.callback_prefixes))
+        token = _current_update.set(stats)
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            update_errors.inc(handler=stats.handler)
+            raise
+        finally:
+            _current_update.reset(token)
+            update_duration.observe(time.perf_counter() - started, handler=stats.handler)
+            update_db_sessions.observe(stats.db_sessions, handler=stats.handler)
+            update_api_calls.observe(stats.api_calls, handler=stats.handler)
+
+class ApiCallCounter(BaseRequestMiddleware):
+    """Middleware сессии бота: считает вызовы Telegram API"""
+
+    async def __call__(self, make_request, bot, method):
+        api_calls_total.inc(method=type(method).__name__)
+        stats = _current_update.get()
+        if stats is not None:
+            stats.api_calls += 1
+        return await make_request(bot, method)
+
+def instrument_engine(engine):
+    """Считает выдачу соединений из пула (одна на сессию, обратившуюся к БД)"""
+    @event.listens_for(engine.sync_engine.pool, "checkout")
+    def _on_checkout(dbapi_connection, connection_record, connection_proxy):
+        db_sessions_total.inc()
+        stats = _current_update.get()
+        if stats is not None:
+            stats.db_sessions += 1
+
+async def start_metrics_server(host: str, port: int, registry: Registry = REGISTRY) -> web.AppRunner:
+    """Локальный HTTP-эндпоинт /metrics"""
+    async def handle(request):
+        return web.Response(text=registry.render(), content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f"Metrics endpoint on http://{host}:{port}/metrics")
+    return runner
@@ -0,0 +1,28 @@
+"""Миграции схемы и данных (шаги AsyncDatabase.MIGRATIONS).
+
+Бот применяет их сам при запуске, но при деплое удобнее выполнить их
+заранее — тогда реплики стартуют с одной проверкой версии.
+
+Запуск: python migrate.py [DATABASE_URL]
+Например: python migrate.py sqlite+aiosqlite:///bot.db
+"""
+import asyncio
+import logging
+import os
+import sys
+from dotenv import load_dotenv
+from db import AsyncDatabase
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+async def main(dsn: str):
+    db = AsyncDatabase(dsn)
+    before = await db.schema_version()
+    after = await db.migrate()
+    logger.info(f"schema version: {before} -> {after} (latest {len(db.MIGRATIONS)})")
+    await db.engine.dispose()
+
+if __name__ == '__main__':
+    load_dotenv()
+    asyncio.run(main(sys.argv[1] if len(sys.argv) > 1 else os.getenv("DATABASE_URL")))
@@ -0,0 +1,152 @@
+"""Outbox исходящих уведомлений: пишется вместе с изменением баланса, отправляется воркером"""
+import asyncio
+import json
+import logging
+import time
+from collections import OrderedDict
+from broadcast import DELIVERED, BLOCKED, FAILED
+
+logger = logging.getLogger(__name__)
+
+def text_message(chat_id: int, text: str, kind: str, ref=None, reply_markup=None, final: bool = False) -> dict:
+    """Текстовое сообщение для outbox; final — итог операции для MessageTracker"""
+    payload = {"text": text}
+    if reply_markup is not None:
+        payload["reply_markup"] = json.loads(reply_markup.json(exclude_none=True))
+    if final:
+        payload["final"] = True
+    return {"chat_id": chat_id, "method": "message", "payload": payload, "kind": kind, "ref": ref}
+
+def sticker_message(chat_id: int, sticker: str, kind: str, ref=None) -> dict:
+    return {"chat_id": chat_id, "method": "sticker", "payload": {"sticker": sticker}, "kind": kind, "ref": ref}
+
+class OutboxWorker:
+    """Отправляет сообщения из таблицы outbox пачками через Broadcaster.
+
+    Чаты пачки обрабатываются параллельно (до broadcaster.concurrency), сообщения
+    одного чата — по порядку id. Временная ошибка откладывает сообщение с
+    экспоненциальной паузой и останавливает остальные сообщения этого чата;
+    после max_attempts попыток сообщение помечается failed. Бот заблокирован —
+    сообщения чата помечаются blocked. Доставка «хотя бы один раз»: пачка
+    отмечается в БД после отправки. Сообщения failed/blocked хранятся
+    retention секунд, затем удаляются (раз в purge_interval).
+    """
+
+    def __init__(self, db, broadcaster, send, batch_size: int = 200, max_attempts: int = 5,
+                 poll_interval: float = 1.0, max_poll_interval: float = 15.0, retry_delay: float = 5.0,
+                 on_result=None, retention: float = 7 * 86400, purge_interval: float = 3600):
+        self.db = db
+        self.broadcaster = broadcaster
+        self.send = send  # send(chat_id, message_type=..., payload=...)
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.retry_delay = retry_delay
+        self.on_result = on_result  # on_result(kind, ref, status)
+        self.retention = retention
+        self.purge_interval = purge_interval
+        self._purged_at = time.monotonic()
+        self._wake = asyncio.Event()
+
+    def wake(self):
+        """Новые сообщения закоммичены — не ждать poll_interval"""
+        self._wake.set()
+
+    async def run(self):
+        """Пока outbox пуст, пауза между опросами растёт до max_poll_interval.
+
+        Записи этого процесса будят воркер через wake(); опрос нужен для
+        записей других реплик и отложенных повторов.
+        """
+        logger.info("outbox worker started batch_size=%s", self.batch_size)
+        interval = self.poll_interval
+        while True:
+            self._wake.clear()
+            try:
+                processed = await self.drain_once()
+            except Exception as e:
+                logger.error("outbox batch failed error=%s", e)
+                processed = 0
+            await self._purge()
+            if processed:
+                interval = self.poll_interval
+                continue
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=interval)
+                interval = self.poll_interval
+            except asyncio.TimeoutError:
+                interval = min(self.max_poll_interval, interval * 2)
+
+    async def _purge(self):
+        if time.monotonic() - self._purged_at < self.purge_interval:
+            return
+        self._purged_at = time.monotonic()
+        try:
+            purged = await self.db.purge_outbox(self.retention)
+        except Exception as e:
+            logger.error("outbox purge failed error=%s", e)
+            return
+        if purged:
+            logger.info("undelivered outbox messages purged count=%s", purged)
+
+    async def drain(self) -> int:
+        """Отправляет всё, что готово к отправке; отложенные повторы не ждёт"""
+        total = 0
+        while True:
+            processed = await self.drain_once()
+            if not processed:
+                return total
+            total += processed
+
+    async def drain_once(self) -> int:
+        rows = await self.db.fetch_outbox(self.batch_size)
+        if not rows:
+            return 0
+        chats = OrderedDict()
+        for row in rows:
+            chats.setdefault(row.chat_id, []).append(row)
+        result = {"sent": [], "blocked": [], "failed": [], "retry": []}
+        await self.broadcaster.fan_out(chats.values(), lambda chat_rows: self._send_chat(chat_rows, result))
+        await self.db.complete_outbox(result["sent"])
+        await self.db.set_outbox_status(result["blocked"], "blocked")
+        await self.db.set_outbox_status(result["failed"], "failed")
+        for message_id, attempts in result["retry"]:
+            await self.db.retry_outbox(message_id, attempts, min(600.0, self.retry_delay * 2 ** (attempts - 1)))
+        logger.debug("outbox batch rows=%s sent=%s blocked=%s failed=%s retry=%s", len(rows),
+                     len(result["sent"]), len(result["blocked"]), len(result["failed"]), len(result["retry"]))
+        return len(rows)
+
+    async def _send_chat(self, rows, result) -> str:
+        for i, row in enumerate(rows):
+            try:
+                status = await self.broadcaster.deliver(
+                    self.send, row.chat_id, message_type=row.method, payload=json.loads(row.payload)
+                )
+            except Exception as e:
+                # Ошибка вне Telegram API (например, битый payload) — обычная неудачная попытка
+                logger.warning("outbox send failed id=%s chat_id=%s error=%s", row.id, row.chat_id, e)
+                status = FAILED
+            if status == DELIVERED:
+                result["sent"].append(row.id)
+            elif status == BLOCKED:
+                # Остальные сообщения чата всё равно не дойдут
+                for blocked in rows[i:]:
+                    result["blocked"].append(blocked.id)
+                    self._record(blocked, BLOCKED)
+                return BLOCKED
+            else:
+                attempts = (row.attempts or 0) + 1
+                if attempts < self.max_attempts:
+                    # Следующие сообщения чата ждут повтора этого
+                    result["retry"].append((row.id, attempts))
+                    return status
+                logger.warning("outbox message dropped id=%s chat_id=%s kind=%s attempts=%s",
+                               row.id, row.chat_id, row.kind, attempts)
+                result["failed"].append(row.id)
+            self._record(row, status)
+        return DELIVERED
+
+    def _record(self, row, status: str):
+        if self.on_result is not None:
+            self.on_result(row.kind, row.ref, status)
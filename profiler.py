@@ -0,0 +1,109 @@
+"""Профилировщик SQL-запросов: статистика по запросам и журнал медленных"""
+import logging
+import re
+import time
+from collections import deque
+from typing import List
+from sqlalchemy import event
+from metrics import current_handler
+
+logger = logging.getLogger(__name__)
+
+# Литералы и списки параметров схлопываются, чтобы одинаковые запросы попадали в одну строку
+_WHITESPACE_RE = re.compile(r"\s+")
+_STRING_RE = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_RE = re.compile(r"\b\d+(?:\.\d+)?\b")
+_PARAM_LIST_RE = re.compile(r"\((?:\s*(?:\?|\$\d+|%\([^)]*\)s|:\w+)\s*,)+\s*(?:\?|\$\d+|%\([^)]*\)s|:\w+)\s*\)")
+
+def normalize_statement(statement: str) -> str:
+    statement = _WHITESPACE_RE.sub(" ", statement).strip()
+    statement = _STRING_RE.sub("?", statement)
+    statement = _NUMBER_RE.sub("?", statement)
+    return _PARAM_LIST_RE.sub("(...)", statement)
+
+class StatementStats:
+    __slots__ = ("statement", "count", "total", "max", "samples")
+
+    def __init__(self, statement: str, sample_size: int):
+        self.statement = statement
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        # Последние sample_size замеров — по ним считается p95
+        self.samples = deque(maxlen=sample_size)
+
+    def record(self, duration: float):
+        self.count += 1
+        self.total += duration
+        self.max = max(self.max, duration)
+        self.samples.append(duration)
+
+    @property
+    def p95(self) -> float:
+        if not self.samples:
+            return 0.0
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+
+class QueryProfiler:
+    """Подписывается на before/after_cursor_execute движка.
+
+    Запросы дольше slow_query_ms пишутся в лог вместе с обработчиком апдейта,
+    который их выполнил (см. metrics.current_handler).
+    """
+
+    def __init__(self, slow_query_ms: float = 100, sample_size: int = 1000):
+        self.slow_query = slow_query_ms / 1000
+        self.sample_size = sample_size
+        self._stats = {}
+
+    def attach(self, engine):
+        sync_engine = engine.sync_engine
+        event.listen(sync_engine, "before_cursor_execute", self._before)
+        event.listen(sync_engine, "after_cursor_execute", self._after)
+        event.listen(sync_engine, "handle_error", self._on_error)
+        return self
+
+    def _before(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+    def _after(self, conn, cursor, statement, parameters, context, executemany):
+        started = conn.info["query_start"].pop()
+        duration = time.perf_counter() - started
+        key = normalize_statement(statement)
+        stats = self._stats.get(key)
+        if stats is None:
+            stats = self._stats[key] = StatementStats(key, self.sample_size)
+        stats.record(duration)
+        if duration >= self.slow_query:
+            logger.warning(
+                "slow query duration_ms=%.1f handler=%s executemany=%s statement=%s",
+                duration * 1000, current_handler(), executemany, key,
+            )
+
+    @staticmethod
+    def _on_error(context):
+        # Упавший запрос не доходит до after_cursor_execute — снимаем его отметку
+        starts = context.connection.info.get("query_start") if context.connection is not None else None
+        if starts:
+            starts.pop()
+
+    def top(self, n: int = 10, order_by: str = "total") -> List[StatementStats]:
+        return sorted(self._stats.values(), key=lambda s: getattr(s, order_by), reverse=True)[:n]
+
+    def reset(self):
+        self._stats.clear()
+
+    def report(self, n: int = 10, width: int = 120) -> str:
+        """Таблица top-N запросов по суммарному времени"""
+        rows = self.top(n)
+        if not rows:
+            return "Нет данных"
+        lines = [f"{'count':>7} {'total_ms':>10} {'avg_ms':>8} {'p95_ms':>8} {'max_ms':>8}  statement"]
+        for s in rows:
+            statement = s.statement if len(s.statement) <= width else s.statement[:width - 3] + "..."
+            lines.append(
+                f"{s.count:>7} {s.total * 1000:>10.1f} {s.total / s.count * 1000:>8.2f} "
+                f"{s.p95 * 1000:>8.2f} {s.max * 1000:>8.2f}  {statement}"
+            )
+        return "\n".join(lines)
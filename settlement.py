@@ -0,0 +1,25 @@
+"""Расчёт призов тиража"""
+import numpy as np
+
+TICKET_PRICE = 1.0
+# Приз за билет — случайная доля цены билета
+PRIZE_MIN = 0.1
+PRIZE_MAX = 0.5
+
+_rng = np.random.default_rng()
+
+def compute_prizes(entries) -> dict:
+    """Призы по всем билетам тиража одним векторным батчем.
+
+    entries — последовательность (user_id, tickets). Возвращает {user_id: сумма}.
+    Каждый билет округляется до 0.01 TON, как и раньше при поштучном расчёте.
+    """
+    entries = [(user_id, tickets) for user_id, tickets in entries if tickets and tickets > 0]
+    if not entries:
+        return {}
+    user_ids = np.fromiter((e[0] for e in entries), dtype=np.int64, count=len(entries))
+    tickets = np.fromiter((e[1] for e in entries), dtype=np.int64, count=len(entries))
+    prizes = np.round(_rng.uniform(PRIZE_MIN, PRIZE_MAX, int(tickets.sum())) * TICKET_PRICE, 2)
+    uniq, inverse = np.unique(user_ids, return_inverse=True)
+    totals = np.bincount(np.repeat(inverse, tickets), weights=prizes, minlength=len(uniq))
+    return {int(uid): round(float(total), 2) for uid, total in zip(uniq, totals)}
@@ -0,0 +1,74 @@
+"""Приём апдейтов через вебхук (aiohttp)"""
+import asyncio
+import hmac
+import logging
+import re
+from aiohttp import web
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+# Допустимый секрет для setWebhook: 1-256 символов A-Z, a-z, 0-9, _ и -
+SECRET_PATTERN = re.compile(r"^[A-Za-z0-9_-]{1,256}$")
+
+def check_secret_token(secret_token: str):
+    """Без секрета любой может прислать поддельный апдейт от имени админа"""
+    if not secret_token or not SECRET_PATTERN.match(secret_token):
+        raise ValueError("WEBHOOK_SECRET must be set to 1-256 characters A-Z, a-z, 0-9, _ or -")
+
+class SecretTokenRequestHandler(SimpleRequestHandler):
+    """Проверяет секрет из заголовка Telegram и обрабатывает апдейты фоновыми задачами.
+
+    Telegram сразу получает 200, апдейт обрабатывается в отдельной задаче.
+    При остановке close() дожидается незавершённых апдейтов (не дольше shutdown_timeout).
+    """
+
+    def __init__(self, dispatcher, bot, secret_token: str, shutdown_timeout: float = 10.0, **data):
+        check_secret_token(secret_token)
+        super().__init__(dispatcher=dispatcher, bot=bot, handle_in_background=True, **data)
+        self.secret_token = secret_token
+        self.shutdown_timeout = shutdown_timeout
+        self._tasks = set()
+
+    async def handle(self, request: web.Request) -> web.Response:
+        if not hmac.compare_digest(
+            request.headers.get(SECRET_HEADER, ""), self.secret_token
+        ):
+            logger.warning("webhook request rejected: bad secret token remote=%s", request.remote)
+            return web.Response(status=401)
+        try:
+            update = await request.json(loads=self.bot.session.json_loads)
+        except ValueError:
+            return web.Response(status=400)
+        task = asyncio.create_task(self._feed(update))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return web.json_response({}, dumps=self.bot.session.json_dumps)
+
+    __call__ = handle
+
+    async def _feed(self, update: dict):
+        try:
+            await self._background_feed_update(self.bot, update)
+        except Exception:
+            logger.exception("update failed update_id=%s", update.get("update_id"))
+
+    async def close(self):
+        # Сессию бота закрывает main() после остановки остальных сервисов
+        if self._tasks:
+            logger.info("waiting for %s in-flight updates", len(self._tasks))
+            _, pending = await asyncio.wait(set(self._tasks), timeout=self.shutdown_timeout)
+            for task in pending:
+                task.cancel()
+
+async def start_webhook_server(dispatcher, bot, host: str, port: int, path: str,
+                               secret_token: str) -> web.AppRunner:
+    """Поднимает aiohttp-приложение с обработчиком вебхука на path"""
+    app = web.Application()
+    SecretTokenRequestHandler(dispatcher, bot, secret_token=secret_token).register(app, path=path)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f"Webhook endpoint on http://{host}:{port}{path}")
+    return runner